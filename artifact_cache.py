@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+
+from pathlib import Path
+from typing import Any
+
+import metrics
+
+from cache_manager import get_cache_manager
+from settings import get_default_logger, get_settings
+from utils import clone_file, generate_random_filename_in_cache, make_working_copy
+
+ARTIFACT_PREFIX = "art_"
+
+
+def artifact_key(source_key: str, stage: dict[str, Any]) -> str:
+    # the source key identifies the input content, the stage is the
+    # normalized description of the transformers applied to it
+    payload = json.dumps([source_key, stage], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+
+def artifact_paths(key: str, count: int) -> list[Path]:
+    cache_dir = get_settings().cache_dir
+    return [cache_dir / f"{ARTIFACT_PREFIX}{key}.{i}.mp3" for i in range(count)]
+
+
+def lookup_artifacts(key: str, count: int) -> list[Path] | None:
+    paths = artifact_paths(key, count)
+    hit = all(path.exists() for path in paths)
+    metrics.record_cache_lookup("artifact", hit)
+    if not hit:
+        return None
+
+    for path in paths:
+        # keep artifacts that are in use from expiring
+        os.utime(path)
+        get_cache_manager().touch(path)
+
+    get_default_logger().debug(f"Artifact cache hit: {key}")
+    return paths
+
+
+def store_artifacts(key: str, filepaths: list[Path]) -> None:
+    for filepath, artifact_path in zip(filepaths, artifact_paths(key, len(filepaths))):
+        temp_filename = generate_random_filename_in_cache(".mp3")
+        clone_file(filepath, temp_filename)
+        os.replace(temp_filename, artifact_path)
+        get_cache_manager().record(artifact_path)
+
+
+def copy_artifacts(artifact_paths: list[Path]) -> list[Path]:
+    copies = []
+    for artifact_path in artifact_paths:
+        copy_filepath = make_working_copy(artifact_path)
+        get_cache_manager().record(copy_filepath)
+        copies.append(copy_filepath)
+    return copies
@@ -0,0 +1,234 @@
+# a local http stand-in for the Bot API, for running the real polling
+# application under load: updates are queued by the caller and handed out
+# through getUpdates, files are served from local paths and every message
+# the bot sends is reported through `on_message`
+from __future__ import annotations
+
+import email.parser
+import email.policy
+import itertools
+import json
+import threading
+import time
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable
+
+from benchmarks.stubs import BOT_USER
+
+MAX_UPDATES_PER_POLL = 100
+
+
+class ApiError(Exception):
+    pass
+
+
+class FakeBotApi:
+    def __init__(
+        self, token: str, on_message: Callable[[int, dict[str, Any]], None]
+    ) -> None:
+        self.token = token
+        self.on_message = on_message
+        self.uploaded_bytes = 0
+        self.calls: dict[str, int] = {}
+        self._ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+        self._updates: list[dict[str, Any]] = []
+        self._updates_changed = threading.Condition()
+        # files that can be downloaded, and ids of the uploaded ones
+        self._files: dict[str, Path] = {}
+        self._uploaded_file_ids: set[str] = set()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _handler_for(self))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/bot"
+
+    @property
+    def base_file_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/file/bot"
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._updates_changed:
+            self._updates_changed.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def next_id(self) -> int:
+        with self._lock:
+            return next(self._ids)
+
+    def add_file(self, path: Path) -> tuple[str, str]:
+        # returns the file id and the unique file id
+        file_id = f"file{self.next_id()}"
+        with self._lock:
+            self._files[file_id] = path
+        return file_id, f"unique_{file_id}"
+
+    def push_update(self, message: dict[str, Any]) -> None:
+        with self._updates_changed:
+            self._updates.append(
+                {"update_id": next(self._update_ids), "message": message}
+            )
+            self._updates_changed.notify_all()
+
+    def _get_updates(self, offset: int, timeout: float) -> list[dict[str, Any]]:
+        deadline = time.monotonic() + timeout
+        with self._updates_changed:
+            # updates before the offset were confirmed by the bot
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._updates_changed.wait(deadline - time.monotonic())
+            return self._updates[:MAX_UPDATES_PER_POLL]
+
+    def file_path(self, file_id: str) -> Path:
+        with self._lock:
+            return self._files[file_id]
+
+    def _message(self, chat_id: int, **content: Any) -> dict[str, Any]:
+        return {
+            "message_id": self.next_id(),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+            "from": BOT_USER,
+            **content,
+        }
+
+    def _audio(self, media: str, files: dict[str, bytes]) -> dict[str, Any]:
+        if media.startswith("attach://"):
+            content = files[media.removeprefix("attach://")]
+            file_id = f"audio{self.next_id()}"
+            with self._lock:
+                self.uploaded_bytes += len(content)
+                self._uploaded_file_ids.add(file_id)
+        else:
+            file_id = media
+            with self._lock:
+                known = file_id in self._uploaded_file_ids
+            if not known:
+                raise ApiError("Bad Request: wrong file identifier/HTTP URL specified")
+        return {
+            "file_id": file_id,
+            "file_unique_id": f"unique_{file_id}",
+            "duration": 1,
+        }
+
+    def call(self, method: str, params: dict[str, str], files: dict[str, bytes]) -> Any:
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+        chat_id = int(params.get("chat_id", 0))
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return self._get_updates(
+                int(params.get("offset", 0)), float(params.get("timeout", 0))
+            )
+        if method == "getFile":
+            file_id = params["file_id"]
+            try:
+                size = self.file_path(file_id).stat().st_size
+            except KeyError:
+                raise ApiError("Bad Request: invalid file_id") from None
+            return {
+                "file_id": file_id,
+                "file_unique_id": f"unique_{file_id}",
+                "file_size": size,
+                "file_path": f"files/{file_id}",
+            }
+        if method == "sendAudio":
+            media = params.get("audio", "attach://audio")
+            messages = [self._message(chat_id, audio=self._audio(media, files))]
+        elif method == "sendMediaGroup":
+            messages = [
+                self._message(chat_id, audio=self._audio(m["media"], files))
+                for m in json.loads(params["media"])
+            ]
+        elif method == "sendMessage":
+            messages = [self._message(chat_id, text=params.get("text", ""))]
+        else:
+            return True
+
+        for message in messages:
+            self.on_message(chat_id, message)
+        return messages if method == "sendMediaGroup" else messages[0]
+
+
+def _parse_body(
+    content_type: str, body: bytes
+) -> tuple[dict[str, str], dict[str, bytes]]:
+    if content_type.startswith("multipart/form-data"):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+        params, files = {}, {}
+        for part in message.walk():
+            if part.is_multipart():
+                continue
+            name = part.get_param("name", header="content-disposition")
+            payload = part.get_payload(decode=True)
+            if part.get_filename() is not None:
+                files[str(name)] = payload
+            else:
+                params[str(name)] = payload.decode()
+        return params, files
+
+    parsed = urllib.parse.parse_qs(body.decode(), keep_blank_values=True)
+    return {name: values[-1] for name, values in parsed.items()}, {}
+
+
+def _handler_for(api: FakeBotApi) -> type[BaseHTTPRequestHandler]:
+    bot_prefix = f"/bot{api.token}/"
+    file_prefix = f"/file/bot{api.token}/files/"
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+        def _respond(self, status: int, body: bytes, content_type: str) -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self) -> None:
+            if not self.path.startswith(file_prefix):
+                self._respond(404, b"not found", "text/plain")
+                return
+            try:
+                content = api.file_path(
+                    self.path.removeprefix(file_prefix)
+                ).read_bytes()
+            except KeyError:
+                self._respond(404, b"not found", "text/plain")
+                return
+            self._respond(200, content, "application/octet-stream")
+
+        def do_POST(self) -> None:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if not self.path.startswith(bot_prefix):
+                self._respond(404, b"not found", "text/plain")
+                return
+
+            method = self.path.removeprefix(bot_prefix)
+            params, files = _parse_body(self.headers.get("Content-Type", ""), body)
+            try:
+                response = {"ok": True, "result": api.call(method, params, files)}
+                status = 200
+            except ApiError as e:
+                response = {"ok": False, "error_code": 400, "description": str(e)}
+                status = 400
+            self._respond(status, json.dumps(response).encode(), "application/json")
+
+    return Handler
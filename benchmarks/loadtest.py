@@ -0,0 +1,381 @@
+# drives the polling application with simulated users sending a mix of
+# links, playlists, audio replies and cover pictures, against a local
+# stand-in for the Bot API and stub media sources; reports throughput,
+# end-to-end latency and resource use as json
+#
+#   python -m benchmarks.loadtest [--users N] [--messages N]
+#       [--mix link=6,playlist=1,reply=2,picture=1] [--max-p95-ms MS]
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import time
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import main as bot_main
+
+from benchmarks import stubs, synthetic
+from benchmarks.bot_api_server import FakeBotApi
+from benchmarks.suite import benchmark_workdir, git_revision, quiet_logging
+from settings import get_settings
+
+TOKEN = "1:loadtest"
+SCENARIOS = ("link", "playlist", "reply", "picture")
+DEFAULT_MIX = "link=6,playlist=1,reply=2,picture=1"
+PLAYLIST_LENGTH = 5
+FIRST_CHAT_ID = 10_000
+
+LOAD_SONGS = [
+    synthetic.Mp3Spec("song a", 90, 128, cover=True),
+    synthetic.Mp3Spec("song b", 180, 192, cover=True),
+    synthetic.Mp3Spec("song c", 45, 128),
+]
+
+
+@dataclass
+class Outcome:
+    scenario: str
+    latency: float
+    ok: bool
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        scenario, weight = part.split("=")
+        assert scenario in SCENARIOS, f"Unknown scenario {scenario}"
+        weights[scenario] = float(weight)
+    return weights
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    # nearest rank
+    index = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def latency_summary(latencies: list[float]) -> dict[str, Any]:
+    if not latencies:
+        return {"count": 0}
+    values = sorted(ms * 1000 for ms in latencies)
+    return {
+        "count": len(values),
+        "mean_ms": round(statistics.mean(values), 1),
+        "p50_ms": round(percentile(values, 50), 1),
+        "p95_ms": round(percentile(values, 95), 1),
+        "p99_ms": round(percentile(values, 99), 1),
+        "max_ms": round(values[-1], 1),
+    }
+
+
+class LoadGenerator:
+    def __init__(
+        self, api: FakeBotApi, songs: list[Path], cover: Path, args: argparse.Namespace
+    ) -> None:
+        self.api = api
+        self.songs = songs
+        self.cover = cover
+        self.args = args
+        self.mix = parse_mix(args.mix)
+        self.url_songs: dict[str, Path] = {}
+        self.playlists: dict[str, list[str]] = {}
+        self._links = itertools.count()
+        self._inboxes: dict[int, asyncio.Queue[dict[str, Any]]] = {}
+        self._loop = asyncio.get_running_loop()
+
+    def on_message(self, chat_id: int, message: dict[str, Any]) -> None:
+        # called from the threads of the bot api stand-in
+        inbox = self._inboxes.get(chat_id)
+        if inbox is not None:
+            self._loop.call_soon_threadsafe(inbox.put_nowait, message)
+
+    def song_url(self) -> str:
+        if self.args.link_pool:
+            n = random.randrange(self.args.link_pool)
+        else:
+            n = next(self._links)
+        url = f"https://www.youtube.com/watch?v=load{n}"
+        self.url_songs[url] = self.songs[n % len(self.songs)]
+        return url
+
+    def playlist_url(self) -> str:
+        url = f"https://www.youtube.com/playlist?list=load{next(self._links)}"
+        self.playlists[url] = [self.song_url() for _ in range(PLAYLIST_LENGTH)]
+        return url
+
+    def new_message(self, chat_id: int, scenario: str) -> tuple[dict[str, Any], int]:
+        # the message and the number of audio files it should be answered with
+        user = {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+        message: dict[str, Any] = {
+            "message_id": self.api.next_id(),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": user,
+        }
+        if scenario == "link":
+            return {**message, "text": self.song_url()}, 1
+        if scenario == "playlist":
+            return {**message, "text": self.playlist_url()}, PLAYLIST_LENGTH
+
+        # replies to an audio file the user sent earlier
+        file_id, unique_id = self.api.add_file(random.choice(self.songs))
+        parent = {
+            **message,
+            "message_id": self.api.next_id(),
+            "audio": {"file_id": file_id, "file_unique_id": unique_id, "duration": 1},
+        }
+        if scenario == "reply":
+            return {
+                **message,
+                "text": f"title Load test {message['message_id']}",
+                "reply_to_message": parent,
+            }, 1
+
+        photo_id, photo_unique_id = self.api.add_file(self.cover)
+        photo = {
+            "file_id": photo_id,
+            "file_unique_id": photo_unique_id,
+            "width": 1280,
+            "height": 720,
+        }
+        return {**message, "photo": [photo], "reply_to_message": parent}, 1
+
+    async def send_and_wait(self, chat_id: int, scenario: str) -> Outcome:
+        inbox = self._inboxes[chat_id]
+        message, expected_audios = self.new_message(chat_id, scenario)
+
+        start = time.perf_counter()
+        self.api.push_update(message)
+        received, ok = 0, True
+        try:
+            while received < expected_audios:
+                remaining = self.args.timeout - (time.perf_counter() - start)
+                reply = await asyncio.wait_for(inbox.get(), max(remaining, 0))
+                if "audio" in reply:
+                    received += 1
+                elif reply.get("text", "").startswith("```"):
+                    # the bot replies with the traceback when a message fails
+                    ok = False
+                    break
+        except asyncio.TimeoutError:
+            ok = False
+
+        return Outcome(scenario, time.perf_counter() - start, ok)
+
+    async def user(self, chat_id: int) -> list[Outcome]:
+        self._inboxes[chat_id] = asyncio.Queue()
+        scenarios, weights = zip(*self.mix.items())
+        outcomes = []
+        for _ in range(self.args.messages):
+            scenario = random.choices(scenarios, weights)[0]
+            outcomes.append(await self.send_and_wait(chat_id, scenario))
+            # drop the late replies of a failed message
+            while not self._inboxes[chat_id].empty():
+                self._inboxes[chat_id].get_nowait()
+            if self.args.think_time:
+                await asyncio.sleep(random.expovariate(1 / self.args.think_time))
+        return outcomes
+
+    async def run(self) -> list[Outcome]:
+        users = [self.user(FIRST_CHAT_ID + i) for i in range(self.args.users)]
+        return list(itertools.chain.from_iterable(await asyncio.gather(*users)))
+
+
+def resource_usage() -> dict[str, float]:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "cpu_user_s": own.ru_utime,
+        "cpu_system_s": own.ru_stime,
+        "children_cpu_s": children.ru_utime + children.ru_stime,
+        "max_rss_mb": own.ru_maxrss / 1024,
+    }
+
+
+def directory_size(directory: Path) -> int:
+    return sum(p.stat().st_size for p in directory.iterdir() if p.is_file())
+
+
+async def run_load_test(args: argparse.Namespace) -> dict[str, Any]:
+    random.seed(args.seed)
+    loop_lags: list[float] = []
+
+    async def measure_loop_lag() -> None:
+        # how late the event loop runs a callback, sampled every 100ms
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(0.1)
+            loop_lags.append(time.perf_counter() - start - 0.1)
+
+    generator: LoadGenerator | None = None
+
+    def on_message(chat_id: int, message: dict[str, Any]) -> None:
+        if generator is not None:
+            generator.on_message(chat_id, message)
+
+    api = FakeBotApi(TOKEN, on_message)
+    api.start()
+    try:
+        with benchmark_workdir(
+            token=TOKEN,
+            bot_api_url=api.base_url,
+            bot_api_file_url=api.base_file_url,
+        ) as workdir:
+            quiet_logging()
+            print("generating media", file=sys.stderr)
+            samples = workdir / "samples"
+            samples.mkdir()
+            songs = [synthetic.make_mp3(samples, spec) for spec in LOAD_SONGS]
+            cover = synthetic.make_image(samples, (1280, 720), "jpg")
+
+            generator = LoadGenerator(api, songs, cover, args)
+            stubs.serve_local_media(
+                generator.url_songs.__getitem__,
+                cover,
+                args.download_delay,
+                generator.playlists.__getitem__,
+            )
+
+            application = bot_main.build_application(get_settings())
+            async with application:
+                await bot_main.post_init_set_bot_commands(application)
+                assert application.updater is not None
+                await application.updater.start_polling(poll_interval=0, timeout=1)
+                await application.start()
+
+                print(f"running {args.users} users", file=sys.stderr)
+                lag_task = asyncio.create_task(measure_loop_lag())
+                usage_before = resource_usage()
+                start = time.perf_counter()
+                try:
+                    outcomes = await generator.run()
+                finally:
+                    duration = time.perf_counter() - start
+                    lag_task.cancel()
+                    await application.updater.stop()
+                    await application.stop()
+                    await bot_main.post_shutdown_stop_background_tasks(application)
+                usage_after = resource_usage()
+
+            cache_bytes = directory_size(get_settings().cache_dir)
+    finally:
+        api.stop()
+
+    ok = [o for o in outcomes if o.ok]
+    audios = sum(PLAYLIST_LENGTH if o.scenario == "playlist" else 1 for o in ok)
+    resources = {
+        k: round(usage_after[k] - usage_before[k], 2)
+        for k in ("cpu_user_s", "cpu_system_s", "children_cpu_s")
+    }
+    resources["max_rss_mb"] = round(usage_after["max_rss_mb"], 1)
+    resources["cache_mb"] = round(cache_bytes / 1_000_000, 1)
+    if loop_lags:
+        resources["loop_lag_p95_ms"] = round(
+            percentile(sorted(loop_lags), 95) * 1000, 1
+        )
+
+    return {
+        "revision": git_revision(),
+        "cpus": os.cpu_count(),
+        "config": {
+            "users": args.users,
+            "messages_per_user": args.messages,
+            "mix": parse_mix(args.mix),
+            "download_delay_seconds": args.download_delay,
+            "think_time_seconds": args.think_time,
+            "link_pool": args.link_pool,
+            "seed": args.seed,
+        },
+        "duration_s": round(duration, 2),
+        "messages": {
+            "sent": len(outcomes),
+            "ok": len(ok),
+            "failed": len(outcomes) - len(ok),
+        },
+        "throughput": {
+            "messages_per_s": round(len(ok) / duration, 2),
+            "audios_per_s": round(audios / duration, 2),
+            "uploaded_mb_per_s": round(api.uploaded_bytes / duration / 1_000_000, 2),
+        },
+        "latency": {
+            "all": latency_summary([o.latency for o in ok]),
+            **{
+                scenario: latency_summary(
+                    [o.latency for o in ok if o.scenario == scenario]
+                )
+                for scenario in SCENARIOS
+            },
+        },
+        "resources": resources,
+        "api_calls": dict(sorted(api.calls.items())),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=5, help="per user")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="scenario weights")
+    parser.add_argument(
+        "--download-delay",
+        type=float,
+        default=0.5,
+        help="seconds every stub yt-dlp download takes",
+    )
+    parser.add_argument(
+        "--think-time",
+        type=float,
+        default=0.0,
+        help="mean seconds a user waits between messages",
+    )
+    parser.add_argument(
+        "--link-pool",
+        type=int,
+        default=0,
+        help="draw links from this many distinct urls, 0 makes every link new",
+    )
+    parser.add_argument("--timeout", type=float, default=300.0, help="per message")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="defaults to stdout")
+    parser.add_argument(
+        "--max-p95-ms",
+        type=float,
+        help="exit with an error if the p95 latency is higher",
+    )
+    parser.add_argument(
+        "--max-failures",
+        type=int,
+        default=0,
+        help="exit with an error if more messages fail",
+    )
+    args = parser.parse_args()
+
+    report = asyncio.run(run_load_test(args))
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        args.output.write_text(output + "\n")
+
+    failures = []
+    if report["messages"]["failed"] > args.max_failures:
+        failures.append(f"{report['messages']['failed']} messages failed")
+    p95 = report["latency"]["all"].get("p95_ms")
+    if args.max_p95_ms is not None and (p95 is None or p95 > args.max_p95_ms):
+        failures.append(f"p95 latency {p95} ms is over {args.max_p95_ms} ms")
+    if failures:
+        sys.exit("; ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+# stand-ins for the Bot API and yt-dlp, so that whole commands can be timed
+# without the network
+from __future__ import annotations
+
+import asyncio
+import itertools
+import json
+import shutil
+import threading
+import time
+
+from pathlib import Path
+from typing import Any, Callable
+
+from telegram import Bot, Update
+from telegram.request import BaseRequest, RequestData
+
+import cover_store
+import youtube_utils
+import ytdl_engine
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "bot", "username": "bot"}
+
+
+def _media_values(params: dict[str, Any]) -> list[Any]:
+    media = params.get("media")
+    if isinstance(media, str):
+        media = json.loads(media)
+    values = [params.get("audio")]
+    for item in media or []:
+        values += [item.get("media"), item.get("thumbnail")]
+    return values
+
+
+class StubBotRequest(BaseRequest):
+    # answers every Bot API call right away, uploads get fresh file ids
+    def __init__(self) -> None:
+        self.calls: list[str] = []
+        self.uploaded_bytes = 0
+        self._ids = itertools.count(1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _message(self, chat_id: int, audio: Any = None) -> dict[str, Any]:
+        message: dict[str, Any] = {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+            "from": BOT_USER,
+        }
+        if audio is not None:
+            # uploads are attached files, anything else is a known file id
+            uploaded = not isinstance(audio, str) or audio.startswith("attach://")
+            file_id = f"audio{next(self._ids)}" if uploaded else audio
+            message["audio"] = {
+                "file_id": file_id,
+                "file_unique_id": f"unique_{file_id}",
+                "duration": 1,
+            }
+        return message
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: RequestData | None = None,
+        read_timeout: Any = None,
+        write_timeout: Any = None,
+        connect_timeout: Any = None,
+        pool_timeout: Any = None,
+    ) -> tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[1]
+        self.calls.append(endpoint)
+        params: dict[str, Any] = (
+            request_data.parameters if request_data is not None else {}
+        )
+        if request_data is not None and request_data.contains_files:
+            self.uploaded_bytes += sum(
+                len(value[1])
+                for value in request_data.multipart_data.values()
+                if isinstance(value, tuple)
+            )
+
+        # like the real api, which is not in local mode
+        if any(str(value).startswith("file://") for value in _media_values(params)):
+            return (
+                400,
+                json.dumps(
+                    {
+                        "ok": False,
+                        "error_code": 400,
+                        "description": "Bad Request: wrong file identifier",
+                    }
+                ).encode(),
+            )
+
+        chat_id = int(params.get("chat_id", 1))
+        result: Any
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint == "sendAudio":
+            # an uploaded file is not among the parameters
+            result = self._message(chat_id, params.get("audio", "attach://audio"))
+        elif endpoint == "sendMediaGroup":
+            media = params["media"]
+            if isinstance(media, str):
+                media = json.loads(media)
+            result = [self._message(chat_id, m["media"]) for m in media]
+        else:
+            result = self._message(chat_id)
+
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def make_bot() -> tuple[Bot, StubBotRequest]:
+    request = StubBotRequest()
+    return Bot("1:benchmark", request=request, get_updates_request=request), request
+
+
+_update_ids = itertools.count(1)
+
+
+def make_update(bot: Bot, text: str, user_id: int = 7) -> Update:
+    message = {
+        "message_id": next(_update_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "user"},
+        "text": text,
+    }
+    update = Update.de_json({"update_id": next(_update_ids), "message": message}, bot)
+    assert update is not None
+    return update
+
+
+def serve_local_media(
+    song_for_url: Callable[[str], Path],
+    thumbnail: Path | None,
+    delay_seconds: float = 0.0,
+    playlist_entries: Callable[[str], list[str]] | None = None,
+) -> None:
+    # yt-dlp downloads become copies of local files, after `delay_seconds`
+    # of pretended network time; thumbnail urls resolve to the local picture
+    # and playlists expand to `playlist_entries`
+    async def download(url: str, output_template: str) -> dict[str, Any]:
+        await asyncio.sleep(delay_seconds)
+        song = song_for_url(url)
+        shutil.copy(song, output_template)
+        info: dict[str, Any] = {"title": song.stem, "album": "Benchmark"}
+        chapters = youtube_utils.load_chapters(song)
+        if chapters:
+            info["chapters"] = chapters
+        if thumbnail is not None:
+            info["thumbnail"] = f"https://thumbnails.invalid/{thumbnail.name}"
+        return info
+
+    def download_url_to_cache(url: str, output_filepath: Path | None = None) -> Path:
+        assert thumbnail is not None and output_filepath is not None
+        shutil.copy(thumbnail, output_filepath)
+        return output_filepath
+
+    def iterate_playlist_entries(
+        playlist_url: str, on_url: Callable[[str], None], stop: threading.Event
+    ) -> None:
+        assert playlist_entries is not None
+        for url in playlist_entries(playlist_url):
+            if stop.is_set():
+                return
+            time.sleep(delay_seconds / 10)
+            on_url(url)
+
+    setattr(ytdl_engine, "download", download)
+    setattr(cover_store, "download_url_to_cache", download_url_to_cache)
+    if playlist_entries is not None:
+        setattr(youtube_utils, "_iterate_playlist_entries", iterate_playlist_entries)
@@ -0,0 +1,436 @@
+# times the transformers, the thumbnail pipeline, the cache operations and
+# whole commands on synthetic media, and prints the results as json so that
+# runs on different commits can be compared
+#
+#   python -m benchmarks.suite [--repeat N] [--output FILE] [--group NAME ...]
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import itertools
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Iterator, cast
+
+from telegram.ext import CallbackContext
+
+import cover_store
+import cpu_pool
+import handlers
+import image_utils
+import media_probe
+import youtube_utils
+
+from artifact_cache import (
+    artifact_key,
+    copy_artifacts,
+    lookup_artifacts,
+    store_artifacts,
+)
+from benchmarks import stubs, synthetic
+from benchmarks.thumbnails import SAMPLES
+from cache_manager import CacheManager
+from file_id_index import FileIdIndex
+from settings import get_default_logger
+from utils import make_working_copy
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+COVER_URL = "https://covers.invalid/cover.jpg"
+
+TRANSFORMER_CASES = {
+    "title": "title Benchmarked",
+    "artist": "artist Someone Else",
+    "album": "album Somewhere",
+    "cover": f"cover {COVER_URL}",
+    "replacetitle": "replacetitle with;without",
+    "cut": "cut 10 -10",
+    "cuthead": "cuthead 3",
+    "all": "\n".join(
+        ["title Benchmarked", "artist Someone Else", f"cover {COVER_URL}", "cut 5 -5"]
+    ),
+}
+
+CACHE_OPERATIONS = 1000
+
+
+@dataclass
+class Result:
+    group: str
+    name: str
+    timings_ms: list[float] = field(default_factory=list)
+    extra: dict[str, Any] = field(default_factory=dict)
+
+    @contextlib.contextmanager
+    def measure(self) -> Iterator[None]:
+        start = time.perf_counter()
+        yield
+        self.timings_ms.append((time.perf_counter() - start) * 1000)
+
+    def summary(self) -> dict[str, Any]:
+        timings = self.timings_ms
+        return {
+            "group": self.group,
+            "name": self.name,
+            "runs": len(timings),
+            "median_ms": round(statistics.median(timings), 3),
+            "min_ms": round(min(timings), 3),
+            "max_ms": round(max(timings), 3),
+            "stdev_ms": round(statistics.stdev(timings), 3) if len(timings) > 1 else 0,
+            **self.extra,
+        }
+
+
+@dataclass
+class Media:
+    songs: dict[str, Path]
+    images: list[tuple[str, Path]]
+    cover: Path
+    # the stub yt-dlp serves these files for these urls
+    url_songs: dict[str, Path] = field(default_factory=dict)
+    urls: Iterator[int] = field(default_factory=itertools.count)
+
+    def song_url(self, song: Path) -> str:
+        url = f"https://www.youtube.com/watch?v=bench{next(self.urls)}"
+        self.url_songs[url] = song
+        return url
+
+
+def remove(paths: list[Path]) -> None:
+    for path in paths:
+        path.unlink(missing_ok=True)
+
+
+@contextlib.contextmanager
+def benchmark_workdir(**extra_config: Any) -> Iterator[Path]:
+    # the bot reads config.json from the working directory
+    with tempfile.TemporaryDirectory(prefix="mediabot-benchmark-") as tmp:
+        workdir = Path(tmp)
+        config = {
+            "token": "1:benchmark",
+            "log_file": "benchmark.log",
+            "allowed_users": [],
+            "allowed_groups": [],
+            "cache_dir": "media",
+            "cache_timeout_minutes": 60,
+            "file_id_index": "file_ids.sqlite3",
+            **extra_config,
+        }
+        (workdir / "config.json").write_text(json.dumps(config))
+
+        previous_workdir = os.getcwd()
+        os.chdir(workdir)
+        try:
+            yield workdir
+        finally:
+            os.chdir(previous_workdir)
+
+
+def quiet_logging() -> None:
+    # the bot logs everything, down to debug messages of the libraries
+    get_default_logger()
+    logging.getLogger().setLevel(logging.WARNING)
+    get_default_logger().setLevel(logging.WARNING)
+
+
+def generate_media(workdir: Path) -> Media:
+    directory = workdir / "samples"
+    directory.mkdir()
+    songs = {
+        spec.name: synthetic.make_mp3(directory, spec) for spec in synthetic.MP3_SPECS
+    }
+    images = [
+        (
+            f"{name} {size[0]}x{size[1]} {ext}",
+            synthetic.make_image(directory, size, ext),
+        )
+        for name, size, ext in SAMPLES
+    ]
+    cover = synthetic.make_image(directory, (1280, 720), "webp")
+    return Media(songs, images, cover)
+
+
+async def bench_transformers(media: Media, repeat: int) -> list[Result]:
+    results = []
+    for case, text in TRANSFORMER_CASES.items():
+        transformers = handlers.find_transformers(text)
+        # the cover is downloaded once per url, that is timed separately
+        await handlers.prepare_transformers(transformers)
+        for song_name, song in media.songs.items():
+            result = Result("transformers", f"{case} / {song_name}")
+            for _ in range(repeat):
+                working_copy = make_working_copy(song)
+                with result.measure():
+                    outputs = await handlers.apply_transformers(
+                        working_copy, transformers
+                    )
+                remove(outputs)
+            results.append(result)
+
+    for song_name, song in media.songs.items():
+        chapters = youtube_utils.load_chapters(song)
+        if not chapters:
+            continue
+        result = Result("transformers", f"splitchapters / {song_name}")
+        for _ in range(repeat):
+            with result.measure():
+                outputs = await youtube_utils.cut_chapters(song, chapters)
+            remove(outputs)
+        result.extra["outputs"] = len(chapters)
+        results.append(result)
+
+    return results
+
+
+async def bench_thumbnails(media: Media, repeat: int) -> list[Result]:
+    results = []
+    for name, image in media.images:
+        result = Result("thumbnails", f"make_thumbnail / {name}")
+        thumbnail = image.with_name("thumbnail.jpg")
+        for _ in range(repeat):
+            with result.measure():
+                image_utils.make_thumbnail(image, thumbnail)
+            thumbnail.unlink()
+        results.append(result)
+
+    result = Result("thumbnails", "create_thumbnail in the pool")
+    for _ in range(repeat):
+        thumbnail = media.cover.with_name("thumbnail.jpg")
+        with result.measure():
+            await image_utils.create_thumbnail(media.cover, thumbnail)
+        thumbnail.unlink()
+    results.append(result)
+
+    result = Result("thumbnails", "get_cover_for_url, new url")
+    for i in range(repeat):
+        with result.measure():
+            await cover_store.get_cover_for_url(f"https://covers.invalid/new{i}.jpg")
+    results.append(result)
+
+    result = Result("thumbnails", "get_cover_for_url, known url")
+    for _ in range(repeat):
+        with result.measure():
+            await cover_store.get_cover_for_url(COVER_URL)
+    results.append(result)
+
+    return results
+
+
+async def bench_cache(media: Media, workdir: Path, repeat: int) -> list[Result]:
+    results = []
+    song = media.songs[synthetic.MP3_SPECS[1].name]
+
+    result = Result("cache", "make_working_copy")
+    for _ in range(repeat):
+        with result.measure():
+            working_copy = make_working_copy(song)
+        working_copy.unlink()
+    results.append(result)
+
+    result = Result("cache", "artifacts store, lookup and copy")
+    for i in range(repeat):
+        key = artifact_key(f"benchmark{i}", {"cut": ["10", "-10"]})
+        working_copy = make_working_copy(song)
+        with result.measure():
+            store_artifacts(key, [working_copy])
+            artifacts = lookup_artifacts(key, 1)
+            assert artifacts is not None
+            copies = copy_artifacts(artifacts)
+        remove([working_copy, *artifacts, *copies])
+    results.append(result)
+
+    files_directory = workdir / "cache_manager"
+    files_directory.mkdir()
+    files = [files_directory / f"file{i}" for i in range(CACHE_OPERATIONS)]
+    for path in files:
+        path.write_bytes(b"0" * 1024)
+
+    result = Result("cache", "cache manager record, touch and evict")
+    result.extra["files"] = CACHE_OPERATIONS
+    for _ in range(repeat):
+        cache_manager = CacheManager(files_directory, 512 * 1024, 3600)
+        with result.measure():
+            for path in files:
+                cache_manager.record(path)
+            for path in files:
+                cache_manager.touch(path)
+            cache_manager.evict()
+    results.append(result)
+
+    index = FileIdIndex(workdir / "benchmark_file_ids.sqlite3")
+    result = Result("cache", "file id index put and get")
+    result.extra["operations"] = CACHE_OPERATIONS
+    for i in range(repeat):
+        with result.measure():
+            for j in range(CACHE_OPERATIONS):
+                index.put(f"source{i}.{j}", "spec", [f"file{j}"])
+            for j in range(CACHE_OPERATIONS):
+                assert index.get(f"source{i}.{j}", "spec") is not None
+    results.append(result)
+
+    for song_name, song in media.songs.items():
+        working_copy = make_working_copy(song)
+        cold = Result("cache", f"media probe, parse / {song_name}")
+        warm = Result("cache", f"media probe, cached / {song_name}")
+        for i in range(repeat):
+            # a new mtime is a new probe key
+            os.utime(working_copy, ns=(i, i))
+            with cold.measure():
+                await media_probe.probe(working_copy)
+            with warm.measure():
+                await media_probe.probe(working_copy)
+        working_copy.unlink()
+        results += [cold, warm]
+
+    return results
+
+
+async def bench_commands(media: Media, repeat: int) -> list[Result]:
+    bot, request = stubs.make_bot()
+    await bot.initialize()
+    context = cast(CallbackContext, types.SimpleNamespace(bot=bot))
+    # every run comes from a new chat, so that the per-chat rate limits of
+    # one run don't hold back the next
+    chat_ids = itertools.count(1000)
+
+    songs = list(media.songs.values())
+    album = media.songs[synthetic.MP3_SPECS[-1].name]
+
+    def new_links(count: int) -> list[str]:
+        return [media.song_url(songs[i % (len(songs) - 1)]) for i in range(count)]
+
+    cases: dict[str, Callable[[], str]] = {
+        "1 song": lambda: "\n".join(new_links(1)),
+        "10 songs": lambda: "\n".join(new_links(10)),
+        "10 songs, tags and cut": lambda: "\n".join(
+            new_links(10) + ["title Benchmarked", "cover " + COVER_URL, "cut 5 -5"]
+        ),
+        "album, splitchapters": lambda: "\n".join(
+            [media.song_url(album), "splitchapters"]
+        ),
+    }
+    # the same message again is answered with the file ids of the first one
+    repeated_text = "\n".join(new_links(10))
+    cases["10 songs, sent before"] = lambda: repeated_text
+
+    async def react(text: str) -> None:
+        update = stubs.make_update(bot, text, user_id=next(chat_ids))
+        await handlers.react_to_command(update, context)
+
+    await react(repeated_text)
+
+    results = []
+    for case, make_text in cases.items():
+        result = Result("react_to_command", case)
+        calls_before, uploaded_before = len(request.calls), request.uploaded_bytes
+        for _ in range(repeat):
+            text = make_text()
+            with result.measure():
+                await react(text)
+        result.extra["api_calls_per_run"] = (len(request.calls) - calls_before) / repeat
+        result.extra["uploaded_bytes_per_run"] = (
+            request.uploaded_bytes - uploaded_before
+        ) // repeat
+        results.append(result)
+
+    await bot.shutdown()
+    return results
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_benchmarks(
+    groups: list[str], repeat: int, download_delay: float
+) -> list[Result]:
+    results: list[Result] = []
+    with benchmark_workdir() as workdir:
+        quiet_logging()
+
+        print("generating media", file=sys.stderr)
+        media = generate_media(workdir)
+        stubs.serve_local_media(
+            lambda url: media.url_songs[url], media.cover, download_delay
+        )
+
+        benchmarks: dict[str, Callable[[], Awaitable[list[Result]]]] = {
+            "transformers": lambda: bench_transformers(media, repeat),
+            "thumbnails": lambda: bench_thumbnails(media, repeat),
+            "cache": lambda: bench_cache(media, workdir, repeat),
+            "react_to_command": lambda: bench_commands(media, repeat),
+        }
+        try:
+            # like the bot, the workers are started before the first request
+            await cpu_pool.start_cpu_pool()
+            for group in groups:
+                print(f"running {group}", file=sys.stderr)
+                results += await benchmarks[group]()
+        finally:
+            cpu_pool.shutdown_cpu_pool()
+
+    return results
+
+
+GROUPS = ["transformers", "thumbnails", "cache", "react_to_command"]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", type=Path, help="defaults to stdout")
+    parser.add_argument("--group", action="append", choices=GROUPS)
+    parser.add_argument(
+        "--download-delay",
+        type=float,
+        default=0.0,
+        help="seconds every stub yt-dlp download takes",
+    )
+    args = parser.parse_args()
+    assert args.repeat >= 1
+
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    results = asyncio.run(
+        run_benchmarks(args.group or GROUPS, args.repeat, args.download_delay)
+    )
+
+    report = {
+        "revision": git_revision(),
+        "started_at": started_at.isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "repeat": args.repeat,
+        "download_delay_seconds": args.download_delay,
+        "results": [result.summary() for result in results],
+    }
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        args.output.write_text(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
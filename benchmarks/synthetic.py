@@ -0,0 +1,86 @@
+# synthetic media for the benchmarks, generated locally with ffmpeg and Pillow
+from __future__ import annotations
+
+import os
+import subprocess
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+from PIL import Image
+
+import youtube_utils
+
+
+@dataclass(frozen=True)
+class Mp3Spec:
+    name: str
+    duration: int
+    bitrate_kbps: int
+    cover: bool = False
+    chapters: int = 0
+
+
+MP3_SPECS = [
+    Mp3Spec("short 128k", 30, 128),
+    Mp3Spec("song 192k with cover", 240, 192, cover=True),
+    Mp3Spec("song 320k with cover", 240, 320, cover=True),
+    Mp3Spec("album 128k with cover and chapters", 1800, 128, cover=True, chapters=8),
+]
+
+
+def make_image(directory: Path, size: tuple[int, int], ext: str) -> Path:
+    # smooth random blobs, so that the encoders have some real work
+    small_size = (size[0] // 20, size[1] // 20)
+    image = Image.frombytes(
+        "RGB", small_size, os.urandom(small_size[0] * small_size[1] * 3)
+    ).resize(size, Image.Resampling.BICUBIC)
+    path = directory / f"sample_{size[0]}x{size[1]}.{ext}"
+    image.save(path)
+    return path
+
+
+def chapter_list(duration: int, count: int) -> list[dict[str, Any]]:
+    length = duration / count
+    return [
+        {
+            "title": f"Chapter {i + 1}",
+            "start_time": round(i * length, 3),
+            "end_time": round((i + 1) * length, 3),
+        }
+        for i in range(count)
+    ]
+
+
+def make_mp3(directory: Path, spec: Mp3Spec) -> Path:
+    # a sine sweep with a bit of noise, encoded at a constant bitrate; the
+    # chapters are written next to it the way youtube_utils saves them
+    path = directory / (spec.name.replace(" ", "_") + ".mp3")
+    cmd = ["ffmpeg", "-y", "-loglevel", "error"]
+    cmd += [
+        "-f",
+        "lavfi",
+        "-i",
+        f"sine=frequency=440:beep_factor=4:duration={spec.duration}",
+    ]
+    cmd += ["-f", "lavfi", "-i", f"anoisesrc=amplitude=0.05:duration={spec.duration}"]
+    if spec.cover:
+        cover = make_image(directory, (1280, 720), "jpg")
+        cmd += ["-i", cover.as_posix()]
+
+    cmd += ["-filter_complex", "[0:a][1:a]amix=inputs=2[a]", "-map", "[a]"]
+    if spec.cover:
+        cmd += ["-map", "2:0", "-c:v", "copy"]
+        cmd += ["-metadata:s:v", "title=Album cover"]
+        cmd += ["-metadata:s:v", "comment=Cover (front)"]
+    cmd += ["-c:a", "libmp3lame", "-b:a", f"{spec.bitrate_kbps}k", "-ar", "44100"]
+    cmd += ["-id3v2_version", "3", "-metadata", f"title={spec.name}"]
+    cmd += ["-metadata", "artist=Benchmark", path.as_posix()]
+    subprocess.run(cmd, check=True)
+
+    if spec.chapters:
+        youtube_utils.save_chapters(
+            path, {"chapters": chapter_list(spec.duration, spec.chapters)}
+        )
+    return path
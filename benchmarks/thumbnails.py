@@ -0,0 +1,118 @@
+# compares the single-pass thumbnail engine with the previous two-pass path
+#
+#   python -m benchmarks.thumbnails [--repeat N] [--concurrency N]
+from __future__ import annotations
+
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+
+from pathlib import Path
+from typing import Callable
+
+from PIL import Image
+
+import cpu_pool
+import image_utils
+
+from benchmarks.synthetic import make_image
+
+SAMPLES = [
+    ("youtube thumbnail", (1280, 720), "webp"),
+    ("youtube thumbnail", (1280, 720), "jpg"),
+    ("album art", (3000, 3000), "jpg"),
+    ("photo", (4032, 3024), "jpg"),
+    ("screenshot", (1920, 1080), "png"),
+]
+
+
+def legacy_thumbnail(src: Path, dest: Path) -> None:
+    # decode everything, write a full size jpeg, decode it again, crop,
+    # resize and write again
+    converted = src.with_suffix(".converted.jpg")
+    Image.open(src).convert("RGB").save(converted)
+
+    im = Image.open(converted).convert("RGB")
+    thumbnail = image_utils.crop_max_square(im).resize(
+        (image_utils.THUMBNAIL_WIDTH, image_utils.THUMBNAIL_WIDTH),
+        Image.Resampling.LANCZOS,
+    )
+    thumbnail.save(converted, quality=95)
+    converted.rename(dest)
+
+
+def time_ms(fn: Callable[[Path, Path], None], src: Path, repeat: int) -> float:
+    dest = src.with_name("thumbnail.jpg")
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(src, dest)
+        timings.append((time.perf_counter() - start) * 1000)
+        dest.unlink()
+    return statistics.median(timings)
+
+
+async def time_concurrent_s(
+    directory: Path, src: Path, concurrency: int, use_pool: bool
+) -> float:
+    dests = [directory / f"concurrent_{i}.jpg" for i in range(concurrency)]
+    start = time.perf_counter()
+    if use_pool:
+        await asyncio.gather(
+            *(image_utils.create_thumbnail(src, dest) for dest in dests)
+        )
+    else:
+        copies = [directory / f"copy_{i}{src.suffix}" for i in range(concurrency)]
+        for copy in copies:
+            copy.write_bytes(src.read_bytes())
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(
+                asyncio.to_thread(legacy_thumbnail, copy, dest)
+                for copy, dest in zip(copies, dests)
+            )
+        )
+    elapsed = time.perf_counter() - start
+    for dest in dests:
+        dest.unlink()
+    return elapsed
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+
+        print(f"{'sample':<34} {'legacy ms':>10} {'single-pass ms':>15} {'speedup':>8}")
+        for name, size, ext in SAMPLES:
+            src = make_image(directory, size, ext)
+            legacy = time_ms(legacy_thumbnail, src, args.repeat)
+            single_pass = time_ms(image_utils.make_thumbnail, src, args.repeat)
+            label = f"{name} {size[0]}x{size[1]} {ext}"
+            print(
+                f"{label:<34} {legacy:>10.1f} {single_pass:>15.1f} "
+                f"{legacy / single_pass:>7.1f}x"
+            )
+
+        src = make_image(directory, (1280, 720), "webp")
+        # warm up the workers, their start is not part of the steady state
+        await time_concurrent_s(directory, src, cpu_pool.CPU_WORKERS, True)
+        threads = await time_concurrent_s(directory, src, args.concurrency, False)
+        pool = await time_concurrent_s(directory, src, args.concurrency, True)
+        print(
+            f"\n{args.concurrency} concurrent 1280x720 webp thumbnails: "
+            f"legacy in threads {threads:.2f}s, "
+            f"single-pass in the process pool {pool:.2f}s"
+        )
+
+    cpu_pool.shutdown_cpu_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
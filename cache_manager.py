@@ -0,0 +1,246 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import time
+
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import metrics
+
+from settings import get_default_logger, get_settings
+from utils import (
+    pin_cache_file,
+    remove_stale_lock_files,
+    unpin_cache_file,
+    unused_cache_file,
+)
+
+EVICTION_INTERVAL_SECONDS = 60
+RECONCILE_INTERVAL_SECONDS = 60 * 60
+
+# files touched this recently are never evicted; covers the short windows
+# between a file appearing in the cache and its user pinning it
+MIN_EVICTION_AGE_SECONDS = 60
+
+WORKING_FILE_PREFIX = "tmp_"
+IGNORED_FILES = (".gitkeep",)
+
+
+@dataclass
+class CacheEntry:
+    size: int
+    last_access: float
+
+
+class CacheManager:
+    # in-memory index of the cache directory, ordered from the least to the
+    # most recently used file; eviction runs in a background task and never
+    # removes files pinned or being written by any process sharing the cache
+    def __init__(
+        self, cache_dir: Path, max_bytes: int | None, ttl_seconds: int
+    ) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[Path, CacheEntry] = OrderedDict()
+        self._total_bytes = 0
+        # a pinned file is locked once per process, however many times it is
+        # pinned; lock file descriptors by path
+        self._pins: Counter[Path] = Counter()
+        self._pin_fds: dict[Path, int] = {}
+        self._task: asyncio.Task[None] | None = None
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def record(self, path: Path, last_access: float | None = None) -> None:
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            self.forget(path)
+            return
+
+        self.forget(path)
+        self._entries[path] = CacheEntry(
+            size, time.time() if last_access is None else last_access
+        )
+        self._total_bytes += size
+
+    def touch(self, path: Path) -> None:
+        entry = self._entries.get(path)
+        if entry is None:
+            self.record(path)
+            return
+
+        entry.last_access = time.time()
+        self._entries.move_to_end(path)
+
+    def forget(self, path: Path) -> None:
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self._total_bytes -= entry.size
+
+    def _pin(self, path: Path) -> None:
+        if self._pins[path] == 0:
+            # the pins of the other processes are seen through lock files
+            self._pin_fds[path] = pin_cache_file(path)
+        self._pins[path] += 1
+
+    def _unpin(self, path: Path) -> None:
+        self._pins[path] -= 1
+        if self._pins[path] <= 0:
+            del self._pins[path]
+            unpin_cache_file(path, self._pin_fds.pop(path))
+
+    @contextlib.contextmanager
+    def pinned(self, paths: Iterable[Path]) -> Iterator[None]:
+        pinned: list[Path] = []
+        try:
+            for path in paths:
+                self._pin(path)
+                pinned.append(path)
+            yield
+        finally:
+            for path in pinned:
+                self._unpin(path)
+
+    def _is_evictable(self, path: Path, entry: CacheEntry, now: float) -> bool:
+        return (
+            self._pins[path] <= 0 and entry.last_access < now - MIN_EVICTION_AGE_SECONDS
+        )
+
+    def evict(self) -> list[Path]:
+        now = time.time()
+        cutoff_time = now - self.ttl_seconds
+
+        to_evict: dict[Path, None] = {}
+        for path, entry in self._entries.items():
+            if entry.last_access >= cutoff_time:
+                # entries are ordered by access time, the rest is fresher
+                break
+            if self._is_evictable(path, entry, now):
+                to_evict[path] = None
+
+        if self.max_bytes is not None:
+            excess_bytes = self._total_bytes - self.max_bytes
+            excess_bytes -= sum(self._entries[path].size for path in to_evict)
+            for path, entry in self._entries.items():
+                if excess_bytes <= 0:
+                    break
+                # working files are transient, they only expire by age
+                if path.name.startswith(WORKING_FILE_PREFIX) or path in to_evict:
+                    continue
+                if self._is_evictable(path, entry, now):
+                    to_evict[path] = None
+                    excess_bytes -= entry.size
+
+        for path in list(to_evict):
+            with unused_cache_file(path) as unused:
+                if not unused:
+                    del to_evict[path]
+                    continue
+                self.forget(path)
+                path.unlink(missing_ok=True)
+
+        if to_evict:
+            get_default_logger().info(f"Evicted {len(to_evict)} files from cache")
+        return list(to_evict)
+
+    def _scan(self) -> list[tuple[Path, int, float]]:
+        scanned = []
+        for path in self.cache_dir.iterdir():
+            if path.name in IGNORED_FILES:
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if path.is_file():
+                scanned.append((path, stat.st_size, stat.st_mtime))
+        return scanned
+
+    async def reconcile(self) -> None:
+        # full directory scan off the event loop; picks up files nobody
+        # recorded and drops entries whose files are gone
+        scanned = await asyncio.to_thread(self._scan)
+        await asyncio.to_thread(remove_stale_lock_files, self.cache_dir)
+
+        seen = set()
+        for path, size, mtime in scanned:
+            seen.add(path)
+            entry = self._entries.get(path)
+            if entry is None:
+                self.record(path, last_access=mtime)
+            elif entry.size != size:
+                self._total_bytes += size - entry.size
+                entry.size = size
+
+        for path in list(self._entries):
+            if path not in seen:
+                self.forget(path)
+
+        # files found on disk were inserted with their mtime, restore the order
+        self._entries = OrderedDict(
+            sorted(self._entries.items(), key=lambda item: item[1].last_access)
+        )
+
+    async def run(self) -> None:
+        # the first pass indexes the files already in the cache directory
+        last_reconcile = float("-inf")
+        while True:
+            try:
+                if time.monotonic() - last_reconcile > RECONCILE_INTERVAL_SECONDS:
+                    await self.reconcile()
+                    last_reconcile = time.monotonic()
+                self.evict()
+            except Exception as e:
+                get_default_logger().error("Cache maintenance failed", exc_info=e)
+            await asyncio.sleep(EVICTION_INTERVAL_SECONDS)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+
+CACHE_MANAGER: CacheManager | None = None
+
+
+def get_cache_manager() -> CacheManager:
+    global CACHE_MANAGER
+
+    if CACHE_MANAGER is None:
+        settings = get_settings()
+        CACHE_MANAGER = CacheManager(
+            settings.cache_dir,
+            settings.cache_max_bytes,
+            settings.cache_timeout_seconds,
+        )
+
+    return CACHE_MANAGER
+
+
+metrics.Gauge(
+    "mediabot_cache_bytes",
+    "Size of the files in the cache.",
+    lambda: [] if CACHE_MANAGER is None else [({}, CACHE_MANAGER.total_bytes)],
+)
+metrics.Gauge(
+    "mediabot_cache_files",
+    "Number of files in the cache.",
+    lambda: [] if CACHE_MANAGER is None else [({}, len(CACHE_MANAGER))],
+)
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+
+from pathlib import Path
+
+import metrics
+
+from cache_manager import get_cache_manager
+from image_utils import create_thumbnail
+from settings import get_default_logger, get_settings
+from singleflight import SingleFlight
+from utils import (
+    download_url_to_cache,
+    generate_random_filename_in_cache,
+    url_signature,
+)
+
+# processed covers are named after the hash of their bytes, so identical
+# pictures from different urls, tracks or users are stored once; a small
+# file per source url remembers which cover it turned into
+COVER_PREFIX = "cover_"
+COVER_URL_PREFIX = "coverurl_"
+
+_cover_downloads: SingleFlight[Path] = SingleFlight()
+
+
+def cover_path(digest: str) -> Path:
+    return get_settings().cache_dir / f"{COVER_PREFIX}{digest}.jpg"
+
+
+def _url_index_path(url: str) -> Path:
+    return get_settings().cache_dir / f"{COVER_URL_PREFIX}{url_signature(url)}"
+
+
+def _lookup_url(url: str) -> Path | None:
+    index_path = _url_index_path(url)
+    try:
+        path: Path | None = cover_path(index_path.read_text().strip())
+    except FileNotFoundError:
+        path = None
+
+    if path is None or not path.exists():
+        metrics.record_cache_lookup("cover", False)
+        return None
+
+    metrics.record_cache_lookup("cover", True)
+
+    get_cache_manager().touch(index_path)
+    get_cache_manager().touch(path)
+    return path
+
+
+def store_thumbnail(thumbnail: Path) -> Path:
+    # moves a processed thumbnail into the store
+    digest = hashlib.sha256(thumbnail.read_bytes()).hexdigest()[:32]
+    path = cover_path(digest)
+    if path.exists():
+        thumbnail.unlink()
+        get_cache_manager().touch(path)
+    else:
+        os.replace(thumbnail, path)
+        get_cache_manager().record(path)
+    return path
+
+
+def _remember_url(url: str, path: Path) -> None:
+    index_path = _url_index_path(url)
+    temp_filename = generate_random_filename_in_cache()
+    temp_filename.write_text(path.stem.removeprefix(COVER_PREFIX))
+    os.replace(temp_filename, index_path)
+    get_cache_manager().record(index_path)
+
+
+async def _fetch_cover(url: str) -> Path:
+    with metrics.span("download.cover"):
+        picture_filename = await asyncio.to_thread(
+            download_url_to_cache, url, generate_random_filename_in_cache()
+        )
+    metrics.record_bytes("download", picture_filename.stat().st_size)
+
+    thumbnail = generate_random_filename_in_cache(".jpg")
+    try:
+        with metrics.span("thumbnail"):
+            await create_thumbnail(picture_filename, thumbnail)
+    finally:
+        picture_filename.unlink()
+
+    path = store_thumbnail(thumbnail)
+    _remember_url(url, path)
+    return path
+
+
+async def get_cover_for_url(url: str) -> Path:
+    # the picture behind an url is downloaded and processed once, requests
+    # for it made in the meantime wait for that
+    cached = _lookup_url(url)
+    if cached is not None:
+        return cached
+
+    return await _cover_downloads.do(url, lambda: _fetch_cover(url))
+
+
+async def find_cover_for_url(url: str | None) -> Path | None:
+    # for pictures that are nice to have, e.g. video thumbnails
+    if not url:
+        return None
+
+    try:
+        return await get_cover_for_url(url)
+    except Exception as e:
+        get_default_logger().warning(f"Failed to get the cover {url}", exc_info=e)
+        return None
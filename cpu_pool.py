@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import asyncio
+import importlib
+import multiprocessing
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, TypeVar
+
+from settings import disable_logger
+
+# pillow and eyed3 hold the GIL, so picture and tag work runs in worker
+# processes shared by the whole bot; tasks get paths and return small
+# results, file contents are not sent between processes
+
+T = TypeVar("T")
+
+CPU_WORKERS = os.cpu_count() or 1
+# imported by every worker when it starts, not on its first task
+WORKER_MODULES = ("image_utils", "media_probe", "mp3_utils")
+
+
+def _init_worker() -> None:
+    for module in WORKER_MODULES:
+        importlib.import_module(module)
+    disable_logger("PIL.Image")
+    disable_logger("eyed3")
+
+
+def _ready() -> None:
+    pass
+
+
+CPU_POOL: ProcessPoolExecutor | None = None
+
+
+def get_cpu_pool() -> ProcessPoolExecutor:
+    global CPU_POOL
+
+    if CPU_POOL is None:
+        # the bot runs threads, forking it is not safe
+        CPU_POOL = ProcessPoolExecutor(
+            CPU_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        )
+
+    return CPU_POOL
+
+
+def _recycle_pool(pool: ProcessPoolExecutor) -> None:
+    global CPU_POOL
+
+    if CPU_POOL is pool:
+        CPU_POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def run_in_cpu_pool(fn: Callable[..., T], *args: Any) -> T:
+    # a worker that died breaks the whole pool, its tasks are retried once
+    # in a new one
+    loop = asyncio.get_running_loop()
+    pool = get_cpu_pool()
+    try:
+        return await loop.run_in_executor(pool, fn, *args)
+    except BrokenProcessPool:
+        _recycle_pool(pool)
+
+    return await loop.run_in_executor(get_cpu_pool(), fn, *args)
+
+
+async def start_cpu_pool() -> None:
+    # a worker is started for every task submitted while none is idle, so
+    # this starts all of them before the first request needs one
+    await asyncio.gather(*(run_in_cpu_pool(_ready) for _ in range(CPU_WORKERS)))
+
+
+def shutdown_cpu_pool() -> None:
+    global CPU_POOL
+
+    if CPU_POOL is not None:
+        CPU_POOL.shutdown(wait=False, cancel_futures=True)
+        CPU_POOL = None
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+
+from pathlib import Path
+
+from settings import get_settings
+
+# sqlite waits this long for the lock held by another process
+BUSY_TIMEOUT_SECONDS = 30
+
+
+class FileIdIndex:
+    # maps (source key, canonical transformer spec) to the telegram file ids
+    # of the audio files that were sent as the result, so that a repeated
+    # request can be answered without processing or uploading anything. The
+    # worker processes share the database; the methods can wait for another
+    # process holding its lock, call them from a thread
+    def __init__(self, path: Path) -> None:
+        self._db = sqlite3.connect(
+            path, timeout=BUSY_TIMEOUT_SECONDS, check_same_thread=False
+        )
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            # readers and a writer don't block each other
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS file_ids ("
+                " source TEXT NOT NULL,"
+                " spec TEXT NOT NULL,"
+                " file_ids TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " PRIMARY KEY (source, spec))"
+            )
+
+    def get(self, source: str, spec: str) -> list[str] | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT file_ids FROM file_ids WHERE source = ? AND spec = ?",
+                (source, spec),
+            ).fetchone()
+        if row is None:
+            return None
+        return list(json.loads(row[0]))
+
+    def put(self, source: str, spec: str, file_ids: list[str]) -> None:
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO file_ids VALUES (?, ?, ?, ?)",
+                (source, spec, json.dumps(file_ids), time.time()),
+            )
+
+    def forget(self, source: str, spec: str) -> None:
+        with self._lock, self._db:
+            self._db.execute(
+                "DELETE FROM file_ids WHERE source = ? AND spec = ?", (source, spec)
+            )
+
+
+FILE_ID_INDEX: FileIdIndex | None = None
+
+
+def get_file_id_index() -> FileIdIndex:
+    global FILE_ID_INDEX
+
+    if FILE_ID_INDEX is None:
+        FILE_ID_INDEX = FileIdIndex(get_settings().file_id_index)
+
+    return FILE_ID_INDEX
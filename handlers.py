@@ -1,34 +1,42 @@
 from __future__ import annotations
 
-import concurrent.futures
+import asyncio
+import contextlib
+import functools
 import itertools
 import os
-import time
+import sqlite3
 
 from collections import defaultdict
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import AsyncIterator
 
 import telegram.error
 
 from telegram import Update
 from telegram.ext import CallbackContext
 
-import mp3_utils
+import metrics
 
-from media_fetcher import fetch_targets
+from cache_manager import get_cache_manager
+from cover_store import get_cover_for_url
+from file_id_index import get_file_id_index
+from job_queue import get_job_queue
+from media_fetcher import Source, collect_sources, fetch_source
 from message import MsgWrapper
+from pipeline import PipelineStage, run_pipeline
+from scheduler import DEFAULT_STAGE_SLOTS, Job, Stage, get_scheduler, job_priority
 from settings import get_default_logger, get_settings
 from telegram_helpers import (
+    MEDIA_GROUP_MAX_SIZE,
     log_exception_and_notify_chat,
-    post_audio_to_telegram,
+    send_audios,
     send_reply,
 )
-from utils import _escape_markdown_v2, url_to_thumbnail_filename
-
-METADATA_TRANSFORMERS = ("title", "artist", "album")
-LENGTH_TRANSFORMERS = ("cut", "cuthead", "splitchapters")
-GENERAL_TRANSFORMERS = ("cover", "replacetitle")
-TRANSFORMERS = METADATA_TRANSFORMERS + LENGTH_TRANSFORMERS + GENERAL_TRANSFORMERS
+from transform_plan import TRANSFORMERS, canonical_spec, compile_plan, execute_plan
+from upload_batcher import Media, UploadBatcher
+from utils import _escape_markdown_v2
 
 
 def find_transformers(text: str) -> dict[str, list[list[str]]]:
@@ -45,73 +53,113 @@ def find_transformers(text: str) -> dict[str, list[list[str]]]:
     return transformers
 
 
-def prepare_transformers(transformers: dict[str, list[list[str]]]) -> None:
+async def prepare_transformers(transformers: dict[str, list[list[str]]]) -> None:
     for args in transformers.get("cover", []):
         picture_url = args[0]
-        thumbnail_filepath = url_to_thumbnail_filename(picture_url)
+        thumbnail_filepath = await get_cover_for_url(picture_url)
         assert thumbnail_filepath.exists(), "Thumbnail file does not exist"
 
 
-def apply_transformer(
-    filepath: Path, name: str, args_lst: list[list[str]]
+async def apply_transformers(
+    filepath: Path,
+    transformers: dict[str, list[list[str]]],
+    source_key: str | None = None,
 ) -> list[Path]:
-    if name in METADATA_TRANSFORMERS:
-        assert len(args_lst) == 1, f"{name} can only be used once"
-        mp3_utils.change_metadata(filepath, name, " ".join(args_lst[0]))
-        return [filepath]
-    elif name == "cover":
-        assert len(args_lst) == 1, f"cover can only be used once, {args_lst}"
-        picture_url = args_lst[-1][0]
-        thumbnail_filepath = url_to_thumbnail_filename(picture_url)
-        mp3_utils.set_cover(filepath, thumbnail_filepath)
-        return [filepath]
-    elif name == "replacetitle":
-        # format: replacetitle a;b
-        title = mp3_utils.read_metadata(filepath)["title"]
-        for args in args_lst:
-            arg = " ".join(args).strip()
-            if arg.endswith(";"):
-                old_part, new_part = arg.strip(";"), ""
-            else:
-                old_part, new_part = arg.split(";")
-            title = title.replace(old_part, new_part).strip()
-        mp3_utils.change_metadata(filepath, "title", title)
-        return [filepath]
-    elif name == "cut":
-        assert len(args_lst) == 1, "cut can only be used once"
-        args = args_lst[-1]
-        start, end = args
-        return [mp3_utils.cut_audio(filepath, start, end)]
-    elif name == "cuthead":
-        assert len(args_lst) == 1, "cuthead can only be used once"
-        args = args_lst[0]
-        assert len(args) <= 1, "Too many arguments for cuthead (expected 0 or 1)"
-        seconds = int(args[0]) if args else 5
-        filepaths: list[Path] = [
-            mp3_utils.cut_audio(filepath, start=i, end=0, overwrite=False)
-            for i in range(1, seconds + 1)
-        ]
-        filepath.unlink()
-        return filepaths
-    elif name == "splitchapters":
-        # already done elsewhere
-        return [filepath]
-    else:
-        raise Exception("Unknown transformer name: " + name)
+    return await execute_plan(filepath, compile_plan(transformers), source_key)
 
 
-def apply_transformers(
-    filepath: Path, transformers: dict[str, list[list[str]]]
+async def apply_transformers_in_scheduler_slot(
+    filepath: Path,
+    transformers: dict[str, list[list[str]]],
+    source_key: str,
+    job: Job,
 ) -> list[Path]:
-    filepaths = [filepath]
-    for name, transformers_args in transformers.items():
-        filepaths = list(
-            itertools.chain.from_iterable(
-                apply_transformer(filepath, name, transformers_args)
-                for filepath in filepaths
-            )
+    async with get_scheduler().slot(Stage.TRANSFORM, job), metrics.span(
+        "transform", transformers=sorted(transformers)
+    ):
+        return await apply_transformers(filepath, transformers, source_key)
+
+
+async def transform_source_files(
+    source: Source,
+    filepaths: list[Path],
+    transformers: dict[str, list[list[str]]],
+    job: Job,
+) -> list[Path]:
+    # chapters of a source are different inputs, they need their own keys
+    if "splitchapters" in transformers:
+        source_keys = [f"{source.key}.chapter{i}" for i in range(len(filepaths))]
+    else:
+        source_keys = [source.key for _ in filepaths]
+
+    transformed_files = await asyncio.gather(
+        *(
+            apply_transformers_in_scheduler_slot(filepath, transformers, key, job)
+            for filepath, key in zip(filepaths, source_keys)
+        )
+    )
+    return list(itertools.chain.from_iterable(transformed_files))
+
+
+def create_job_for_message(
+    update: Update, context: CallbackContext, msg: MsgWrapper
+) -> Job:
+    async def notify_queued(position: int) -> None:
+        await send_reply(update, context, f"Queued, position {position + 1}")
+
+    return Job(owner=(msg.chat_id, msg.author_id), on_queued=notify_queued)
+
+
+@dataclass
+class PipelineItem:
+    source: Source
+    # the file ids of the results sent before, they may be sent again
+    file_ids: list[str] | None = None
+    filepaths: list[Path] = field(default_factory=list)
+    # the working files of the item stay pinned until it is uploaded
+    pins: contextlib.ExitStack = field(default_factory=contextlib.ExitStack)
+
+
+async def iterate_pipeline_items(
+    msg: MsgWrapper, job: Job, spec: str
+) -> AsyncIterator[PipelineItem]:
+    # the job drops to batch priority once it turns out to have many items
+    sources_count = 0
+    async for source in collect_sources(msg):
+        sources_count += 1
+        job.priority = job_priority(sources_count)
+        file_ids = await asyncio.to_thread(get_file_id_index().get, source.key, spec)
+        metrics.record_cache_lookup("file_id", file_ids is not None)
+        metrics.count_in_trace("items", 1)
+        yield PipelineItem(source, file_ids)
+
+
+async def finish_upload(item: PipelineItem, spec: str, file_ids: list[str]) -> None:
+    cache_manager = get_cache_manager()
+    for f in item.filepaths:
+        os.remove(f)
+        cache_manager.forget(f)
+    item.pins.close()
+    try:
+        await asyncio.to_thread(
+            get_file_id_index().put, item.source.key, spec, file_ids
+        )
+    except sqlite3.Error as e:
+        # the files were sent, the job doesn't fail over the index
+        get_default_logger().warning(
+            f"Failed to remember the file ids of {item.source.key}", exc_info=e
         )
-    return filepaths
+
+
+async def ignore_file_ids(file_ids: list[str]) -> None:
+    pass
+
+
+async def send_audios_in_scheduler_slot(
+    update: Update, job: Job, files: list[Media]
+) -> list[str]:
+    async with get_scheduler().slot(Stage.UPLOAD, job):
+        return await send_audios(update, files)
 
 
 async def react_to_command(
@@ -120,36 +168,129 @@ async def react_to_command(
     msg = MsgWrapper(update.message)
     if not msg.is_authorized():
         return
-    cleanup_cache()
 
-    msg_text = msg.text + "\n" + extra_text
-    transformers = find_transformers(msg_text)
-    prepare_transformers(transformers)
+    await process_job(update, context, find_transformers(msg.text + "\n" + extra_text))
 
-    files_to_edit = await fetch_targets(
-        update, context, msg, split_chapters="splitchapters" in transformers
-    )
 
-    target_to_transformed_files: dict[Path, list[Path]] = {}
+async def process_job(
+    update: Update, context: CallbackContext, transformers: dict[str, list[list[str]]]
+) -> None:
+    msg = MsgWrapper(update.message)
+    # everything measured while handling the message ends up in its trace
+    with metrics.trace("message", update_id=update.update_id, chat_id=msg.chat_id):
+        await process_message(update, context, msg, transformers)
+
 
-    cpu_count = os.cpu_count() or 1
-    max_workers = int(cpu_count * 1.5)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_target = {
-            executor.submit(apply_transformers, target, transformers): target
-            for target in files_to_edit
-        }
-        for future in concurrent.futures.as_completed(future_to_target):
+async def process_message(
+    update: Update,
+    context: CallbackContext,
+    msg: MsgWrapper,
+    transformers: dict[str, list[list[str]]],
+) -> None:
+    await prepare_transformers(transformers)
+
+    job = create_job_for_message(update, context, msg)
+    spec = canonical_spec(transformers)
+    cache_manager = get_cache_manager()
+
+    # albums are sent one at a time when the order matters
+    ordered = get_settings().ordered_delivery
+    send = functools.partial(send_audios_in_scheduler_slot, update, job)
+    # the items sent before by the file ids of their results
+    cached_items: dict[str, PipelineItem] = {}
+
+    with contextlib.ExitStack() as items_pins:
+        # the pins of the items that were not uploaded are released when the
+        # job ends
+
+        async def fetch(item: PipelineItem) -> PipelineItem:
+            if item.file_ids is None:
+                items_pins.enter_context(item.pins)
+                item.filepaths = await fetch_source(
+                    context, item.source, "splitchapters" in transformers, job
+                )
+                item.pins.enter_context(cache_manager.pinned(item.filepaths))
+            return item
+
+        async def transform(item: PipelineItem) -> PipelineItem:
+            if item.file_ids is None:
+                item.filepaths = await transform_source_files(
+                    item.source, item.filepaths, transformers, job
+                )
+                item.pins.enter_context(cache_manager.pinned(item.filepaths))
+            return item
+
+        async def send_again(item: PipelineItem) -> None:
+            get_default_logger().warning(
+                f"Cached file ids of {item.source.key} are invalid"
+            )
+            await asyncio.to_thread(get_file_id_index().forget, item.source.key, spec)
+            item.file_ids = None
+            item = await transform(await fetch(item))
+            file_ids = []
+            for i in range(0, len(item.filepaths), MEDIA_GROUP_MAX_SIZE):
+                file_ids += await send(item.filepaths[i : i + MEDIA_GROUP_MAX_SIZE])
+            await finish_upload(item, spec, file_ids)
+
+        async def send_album(files: list[Media]) -> list[str]:
             try:
-                target_to_transformed_files[future_to_target[future]] = future.result()
-            except Exception as exc:
-                await log_exception_and_notify_chat(update, context, exc)
-                raise
+                return await send(files)
+            except telegram.error.BadRequest:
+                if all(isinstance(f, Path) for f in files):
+                    raise
+
+            # a file id sent before was rejected; the files are sent one at a
+            # time, and the items whose file ids are rejected are made and
+            # sent again in place of their cached results. Cached items ignore
+            # the file ids they get back, so theirs are passed through
+            file_ids: list[str] = []
+            sent_again: set[int] = set()
+            for f in files:
+                if isinstance(f, str) and id(cached_items[f]) in sent_again:
+                    file_ids.append(f)
+                    continue
+                try:
+                    file_ids += await send([f])
+                except telegram.error.BadRequest:
+                    if isinstance(f, Path):
+                        raise
+                    sent_again.add(id(cached_items[f]))
+                    await send_again(cached_items[f])
+                    file_ids.append(f)
+            return file_ids
+
+        uploads = UploadBatcher(
+            send_album,
+            max_in_flight=1 if ordered else DEFAULT_STAGE_SLOTS[Stage.UPLOAD],
+        )
 
-    for target in files_to_edit:
-        for f in target_to_transformed_files[target]:
-            await post_audio_to_telegram(update, context, f)
-            os.remove(f)
+        async def deliver(item: PipelineItem) -> None:
+            if item.file_ids is not None:
+                cached_items.update((file_id, item) for file_id in item.file_ids)
+                # the results are in the index already
+                await uploads.add(item.file_ids, ignore_file_ids)
+                return
+            await uploads.add(
+                item.filepaths, functools.partial(finish_upload, item, spec)
+            )
+
+        try:
+            await run_pipeline(
+                iterate_pipeline_items(msg, job, spec),
+                [
+                    PipelineStage(fetch, DEFAULT_STAGE_SLOTS[Stage.DOWNLOAD]),
+                    PipelineStage(transform, DEFAULT_STAGE_SLOTS[Stage.TRANSFORM]),
+                ],
+                deliver,
+                ordered=ordered,
+                sink_buffer_size=MEDIA_GROUP_MAX_SIZE,
+            )
+            await uploads.join()
+        except Exception as exc:
+            await log_exception_and_notify_chat(update, context, exc)
+            raise
+        finally:
+            uploads.cancel()
 
 
 async def handler_message(update: Update, context: CallbackContext) -> None:
@@ -158,12 +299,39 @@ async def handler_message(update: Update, context: CallbackContext) -> None:
     await react_to_command(update, context)
 
 
+async def picture_as_cover(update: Update) -> str:
+    picture_url = (await MsgWrapper(update.message).picture).file_path
+    return f"cover {picture_url}"
+
+
 async def handler_picture(update: Update, context: CallbackContext) -> None:
     get_default_logger().info("Picture received")
 
-    picture_url = (await MsgWrapper(update.message).picture).file_path
+    await react_to_command(update, context, extra_text=await picture_as_cover(update))
+
+
+async def enqueue_command(update: Update, extra_text: str = "") -> None:
+    # ingress mode: the message is processed by one of the worker processes
+    msg = MsgWrapper(update.message)
+    if not msg.is_authorized():
+        return
 
-    await react_to_command(update, context, extra_text=f"cover {picture_url}")
+    transformers = find_transformers(msg.text + "\n" + extra_text)
+    payload = {"update": update.to_dict(), "transformers": transformers}
+    if await asyncio.to_thread(get_job_queue().put, update.update_id, payload):
+        get_default_logger().info(f"Update {update.update_id} queued")
+
+
+async def ingress_handler_message(update: Update, context: CallbackContext) -> None:
+    get_default_logger().info("Message received")
+
+    await enqueue_command(update)
+
+
+async def ingress_handler_picture(update: Update, context: CallbackContext) -> None:
+    get_default_logger().info("Picture received")
+
+    await enqueue_command(update, extra_text=await picture_as_cover(update))
 
 
 async def log_error_and_send_info_to_parent(
@@ -225,13 +393,3 @@ Reply with a picture to set it as the cover.\n
             help_text,
             parse_mode=telegram.constants.ParseMode.MARKDOWN_V2,
         )
-
-
-def cleanup_cache() -> None:
-    cutoff_time = time.time() - get_settings().cache_timeout_seconds
-
-    for filename in get_settings().cache_dir.iterdir():
-        if filename.name == ".gitkeep":
-            continue
-        if filename.stat().st_mtime < cutoff_time:
-            filename.unlink()
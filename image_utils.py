@@ -1,21 +1,19 @@
+import math
+
 from pathlib import Path
 
 from PIL import Image
 
-DESIRED_THUMBNAIL_FORMAT = "jpg"
-THUMBNAIL_WIDTH = 300
-
-
-def convert_image_to_format(image_filepath: Path, desired_format: str) -> Path:
-    desired_filepath = image_filepath.with_suffix(f".{desired_format}")
-
-    im = Image.open(image_filepath).convert("RGB")
-    im.save(desired_filepath)
+import cpu_pool
 
-    return desired_filepath
+THUMBNAIL_WIDTH = 300
+THUMBNAIL_QUALITY = 95
+# resize in two steps, a fast integer reduction first; the result is
+# indistinguishable from a plain LANCZOS resize at this factor
+THUMBNAIL_REDUCING_GAP = 3.0
 
 
-def crop_center(pil_img: Image, crop_width: int, crop_height: int) -> Image:
+def crop_center(pil_img: Image.Image, crop_width: int, crop_height: int) -> Image.Image:
     img_width, img_height = pil_img.size
     return pil_img.crop(
         (
@@ -27,19 +25,34 @@ def crop_center(pil_img: Image, crop_width: int, crop_height: int) -> Image:
     )
 
 
-def crop_max_square(pil_img: Image) -> Image:
+def crop_max_square(pil_img: Image.Image) -> Image.Image:
     return crop_center(pil_img, min(pil_img.size), min(pil_img.size))
 
 
-def crop_image_to_square(path_to_image: Path) -> None:
-    im = Image.open(path_to_image).convert("RGB")
-    im_thumb = crop_max_square(im).resize(
-        (THUMBNAIL_WIDTH, THUMBNAIL_WIDTH), Image.LANCZOS
+def thumbnail_draft_size(size: tuple[int, int]) -> tuple[int, int]:
+    # the smallest size whose centre square still covers the thumbnail
+    side = min(size)
+    return (
+        math.ceil(size[0] * THUMBNAIL_WIDTH / side),
+        math.ceil(size[1] * THUMBNAIL_WIDTH / side),
     )
-    im_thumb.save(path_to_image, quality=95)
 
 
-def convert_raw_picture_to_thumbnail_format_and_shape(picture_filename: Path) -> Path:
-    thumbnail = convert_image_to_format(picture_filename, DESIRED_THUMBNAIL_FORMAT)
-    crop_image_to_square(thumbnail)
-    return thumbnail
+def make_thumbnail(src: Path, dest: Path) -> None:
+    # one decode and one encode: jpegs are decoded at a reduced scale right
+    # away, the square is cut out before anything is resized or converted
+    with Image.open(src) as im:
+        im.draft("RGB", thumbnail_draft_size(im.size))
+        square = crop_max_square(im)
+        if square.mode != "RGB":
+            square = square.convert("RGB")
+        thumbnail = square.resize(
+            (THUMBNAIL_WIDTH, THUMBNAIL_WIDTH),
+            Image.Resampling.LANCZOS,
+            reducing_gap=THUMBNAIL_REDUCING_GAP,
+        )
+    thumbnail.save(dest, format="JPEG", quality=THUMBNAIL_QUALITY)
+
+
+async def create_thumbnail(src: Path, dest: Path) -> None:
+    await cpu_pool.run_in_cpu_pool(make_thumbnail, src, dest)
@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import metrics
+
+from settings import get_settings
+
+# a worker renews the lease of its job every third of this; a job whose
+# lease runs out is handed to another worker, up to MAX_ATTEMPTS times
+LEASE_SECONDS = 60
+MAX_ATTEMPTS = 3
+FINISHED_JOBS_TTL_SECONDS = 7 * 24 * 60 * 60
+PURGE_INTERVAL_SECONDS = 60 * 60
+# sqlite waits this long for the lock held by another process
+BUSY_TIMEOUT_SECONDS = 30
+
+
+@dataclass
+class QueuedJob:
+    id: int
+    payload: dict[str, Any]
+    attempts: int
+
+
+class JobQueue:
+    # durable queue of messages to process, shared by the ingress and the
+    # worker processes through a sqlite file; jobs are taken in the order
+    # they were queued. The methods can wait for other processes holding the
+    # database lock, call them from a thread
+    def __init__(self, path: Path) -> None:
+        self._db = sqlite3.connect(
+            path, timeout=BUSY_TIMEOUT_SECONDS, check_same_thread=False
+        )
+        self._lock = threading.Lock()
+        self._purged_at = 0.0
+        with self._lock, self._db:
+            # readers and a writer don't block each other
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " update_id INTEGER UNIQUE,"
+                " payload TEXT NOT NULL,"
+                " state TEXT NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " owner TEXT,"
+                " lease_expires_at REAL,"
+                " error TEXT,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, id)"
+            )
+
+        # the counts are read from the metrics gauge on the event loop; a
+        # reader never waits for a writer with the journal in wal mode
+        self._counts_db = sqlite3.connect(path, check_same_thread=False)
+        self._counts_lock = threading.Lock()
+
+    def put(self, update_id: int, payload: dict[str, Any]) -> bool:
+        # an update delivered again is queued once; returns whether it's new
+        now = time.time()
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO jobs"
+                " (update_id, payload, state, created_at, updated_at)"
+                " VALUES (?, ?, 'queued', ?, ?)",
+                (update_id, json.dumps(payload), now, now),
+            )
+        return cursor.rowcount == 1
+
+    def lease(self, owner: str) -> QueuedJob | None:
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE jobs SET state = 'failed', owner = NULL, updated_at = ?,"
+                " error = 'The lease of the last attempt expired'"
+                " WHERE state = 'leased' AND lease_expires_at < ? AND attempts >= ?",
+                (now, now, MAX_ATTEMPTS),
+            )
+            # a single statement, so no two workers can take the same job
+            row = self._db.execute(
+                "UPDATE jobs SET state = 'leased', attempts = attempts + 1,"
+                " owner = ?, lease_expires_at = ?, updated_at = ?"
+                " WHERE id = ("
+                "  SELECT id FROM jobs"
+                "  WHERE state = 'queued'"
+                "   OR (state = 'leased' AND lease_expires_at < ?)"
+                "  ORDER BY id LIMIT 1)"
+                " RETURNING id, payload, attempts",
+                (owner, now + LEASE_SECONDS, now, now),
+            ).fetchone()
+
+        if row is None:
+            return None
+        return QueuedJob(row[0], json.loads(row[1]), row[2])
+
+    def renew(self, job_id: int, owner: str) -> bool:
+        # false if the lease ran out and the job was taken by someone else
+        now = time.time()
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                "UPDATE jobs SET lease_expires_at = ?, updated_at = ?"
+                " WHERE id = ? AND owner = ? AND state = 'leased'",
+                (now + LEASE_SECONDS, now, job_id, owner),
+            )
+        return cursor.rowcount == 1
+
+    def _finish(
+        self, job_id: int, owner: str, state: str, error: str | None = None
+    ) -> None:
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE jobs SET state = ?, error = ?, owner = NULL, updated_at = ?"
+                " WHERE id = ? AND owner = ? AND state = 'leased'",
+                (state, error, now, job_id, owner),
+            )
+            if now - self._purged_at > PURGE_INTERVAL_SECONDS:
+                # finished jobs are kept for a while, so that an update
+                # delivered again is recognised
+                self._db.execute(
+                    "DELETE FROM jobs"
+                    " WHERE state IN ('done', 'failed') AND updated_at < ?",
+                    (now - FINISHED_JOBS_TTL_SECONDS,),
+                )
+                self._purged_at = now
+
+    def complete(self, job_id: int, owner: str) -> None:
+        self._finish(job_id, owner, "done")
+
+    def fail(self, job_id: int, owner: str, error: str) -> None:
+        self._finish(job_id, owner, "failed", error)
+
+    def release(self, job_id: int, owner: str) -> None:
+        # gives an interrupted job back to the queue
+        self._finish(job_id, owner, "queued")
+
+    def counts(self) -> dict[str, int]:
+        with self._counts_lock:
+            rows = self._counts_db.execute(
+                "SELECT state, COUNT(*) FROM jobs GROUP BY state"
+            ).fetchall()
+        return {state: count for state, count in rows}
+
+
+JOB_QUEUE: JobQueue | None = None
+
+
+def get_job_queue() -> JobQueue:
+    global JOB_QUEUE
+
+    if JOB_QUEUE is None:
+        JOB_QUEUE = JobQueue(get_settings().job_queue)
+
+    return JOB_QUEUE
+
+
+metrics.Gauge(
+    "mediabot_jobs",
+    "Jobs in the queue, by state.",
+    lambda: (
+        []
+        if JOB_QUEUE is None
+        else [({"state": state}, count) for state, count in JOB_QUEUE.counts().items()]
+    ),
+)
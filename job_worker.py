@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import os
+import socket
+import sqlite3
+
+from telegram import Update
+from telegram.ext import Application, CallbackContext
+
+from handlers import process_job
+from job_queue import LEASE_SECONDS, QueuedJob, get_job_queue
+from settings import get_default_logger, get_settings
+
+# how often an idle worker looks for new jobs
+POLL_INTERVAL_SECONDS = 0.5
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+async def keep_lease(
+    job: QueuedJob, owner: str, processing: asyncio.Task[None]
+) -> None:
+    # returns once the lease is lost; the job is stopped then, since another
+    # worker may already be processing it
+    while True:
+        await asyncio.sleep(LEASE_SECONDS / 3)
+        try:
+            renewed = await asyncio.to_thread(get_job_queue().renew, job.id, owner)
+        except sqlite3.Error as e:
+            # the lease may still be renewed before it runs out
+            get_default_logger().warning(f"Failed to renew job {job.id}", exc_info=e)
+            continue
+        if not renewed:
+            get_default_logger().warning(f"Lost the lease of job {job.id}, stopping it")
+            processing.cancel()
+            return
+
+
+async def run_job(application: Application, job: QueuedJob, owner: str) -> None:
+    update = Update.de_json(job.payload["update"], application.bot)
+    assert update is not None
+    context = CallbackContext.from_update(update, application)
+    get_default_logger().info(
+        f"Processing job {job.id} (update {update.update_id}, attempt {job.attempts})"
+    )
+
+    processing = asyncio.create_task(
+        process_job(update, context, job.payload["transformers"])
+    )
+    lease = asyncio.create_task(keep_lease(job, owner, processing))
+    queue = get_job_queue()
+    try:
+        await processing
+    except asyncio.CancelledError:
+        if lease.done() and not lease.cancelled():
+            # someone else owns the job now
+            return
+        await asyncio.shield(asyncio.to_thread(queue.release, job.id, owner))
+        raise
+    except Exception as e:
+        # the chat was told about the error already, like in the single
+        # process mode the job is not retried
+        get_default_logger().error(f"Job {job.id} failed", exc_info=e)
+        await asyncio.to_thread(queue.fail, job.id, owner, repr(e))
+    else:
+        await asyncio.to_thread(queue.complete, job.id, owner)
+    finally:
+        lease.cancel()
+
+
+async def run_worker(application: Application, stop: asyncio.Event) -> None:
+    # takes jobs off the queue until `stop` is set, up to `worker_jobs` at a
+    # time; the jobs that are running then are finished first
+    owner = worker_name()
+    slots = asyncio.Semaphore(get_settings().worker_jobs)
+    running: set[asyncio.Task[None]] = set()
+
+    def on_done(task: asyncio.Task[None]) -> None:
+        running.discard(task)
+        slots.release()
+
+    get_default_logger().info(f"Worker {owner} started")
+    while not stop.is_set():
+        await slots.acquire()
+        job = await asyncio.to_thread(get_job_queue().lease, owner)
+        if job is None:
+            slots.release()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(stop.wait(), POLL_INTERVAL_SECONDS)
+            continue
+
+        task = asyncio.create_task(run_job(application, job, owner))
+        running.add(task)
+        task.add_done_callback(on_done)
+
+    if running:
+        await asyncio.wait(running)
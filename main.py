@@ -1,45 +1,125 @@
+import argparse
+import asyncio
+import signal
+
 from typing import Type
 
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
 
+from cache_manager import get_cache_manager
+from cpu_pool import shutdown_cpu_pool, start_cpu_pool
+from file_id_index import get_file_id_index
 from handlers import (
     HelpCommandHandler,
     handler_message,
     handler_picture,
+    ingress_handler_message,
+    ingress_handler_picture,
     log_error_and_send_info_to_parent,
 )
-from settings import disable_logger, get_settings
+from job_queue import get_job_queue
+from job_worker import run_worker
+from metrics import start_metrics_server, stop_metrics_server
+from settings import Settings, disable_logger, get_settings
+from ytdl_engine import shutdown_ytdl_engine
 
 COMMANDS: list[Type[HelpCommandHandler]] = [HelpCommandHandler]
 
+# `all` polls and processes in one process; `ingress` polls and queues the
+# messages, `worker` processes queued messages, any number of them can run
+MODES = ("all", "ingress", "worker")
 
-async def post_init_set_bot_commands(application: Application) -> None:
+
+async def set_bot_commands(application: Application) -> None:
     await application.bot.set_my_commands(
         [(command.name, command.description) for command in COMMANDS]
     )
 
 
-def main() -> None:
-    settings = get_settings()
+async def start_background_tasks() -> None:
+    get_cache_manager().start()
+    await start_metrics_server()
+    # opening the index may wait for another process holding its lock
+    await asyncio.to_thread(get_file_id_index)
+    await start_cpu_pool()
+
+
+async def post_init_set_bot_commands(application: Application) -> None:
+    await set_bot_commands(application)
+    await start_background_tasks()
+
+
+async def post_init_ingress(application: Application) -> None:
+    await set_bot_commands(application)
+    await start_metrics_server()
+    # opening the queue may wait for another process holding its lock
+    await asyncio.to_thread(get_job_queue)
+
+
+async def post_shutdown_stop_background_tasks(application: Application) -> None:
+    await get_cache_manager().stop()
+    await stop_metrics_server()
+    shutdown_ytdl_engine()
+    shutdown_cpu_pool()
+
 
-    application = (
+def build_application(settings: Settings, mode: str = "all") -> Application:
+    assert mode in MODES, f"Unknown mode: {mode}"
+
+    builder = (
         Application.builder()
         .token(settings.token)
-        .post_init(post_init_set_bot_commands)
-        .build()
+        .concurrent_updates(True)
+        .post_init(
+            post_init_ingress if mode == "ingress" else post_init_set_bot_commands
+        )
+        .post_shutdown(post_shutdown_stop_background_tasks)
     )
+    if settings.bot_api_url:
+        builder = builder.base_url(settings.bot_api_url)
+    if settings.bot_api_file_url:
+        builder = builder.base_file_url(settings.bot_api_file_url)
+    application = builder.build()
 
+    if mode == "ingress":
+        on_message, on_picture = ingress_handler_message, ingress_handler_picture
+    else:
+        on_message, on_picture = handler_message, handler_picture
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_message))
     application.add_handler(
-        MessageHandler(filters.TEXT & ~filters.COMMAND, handler_message)
-    )
-    application.add_handler(
-        MessageHandler(filters.PHOTO, handler_picture),
+        MessageHandler(filters.PHOTO, on_picture),
     )
     for command in COMMANDS:
         application.add_handler(CommandHandler(command.name, command.handler))
 
     application.add_error_handler(log_error_and_send_info_to_parent, block=False)
 
+    return application
+
+
+async def run_worker_process(application: Application) -> None:
+    # workers don't poll, the application is only used for sending
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    async with application:
+        await start_background_tasks()
+        await asyncio.to_thread(get_job_queue)
+        try:
+            await run_worker(application, stop)
+        finally:
+            await post_shutdown_stop_background_tasks(application)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=MODES, default="all")
+    args = parser.parse_args()
+
+    application = build_application(get_settings(), args.mode)
+
     disable_logger("hpack.hpack")
     disable_logger("httpx._client")
     disable_logger("PIL.Image")
@@ -49,7 +129,10 @@ def main() -> None:
 
     # TODO add `podcastify` mode
 
-    application.run_polling()
+    if args.mode == "worker":
+        asyncio.run(run_worker_process(application))
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":
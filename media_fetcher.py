@@ -1,25 +1,29 @@
 from __future__ import annotations
 
-import concurrent.futures
-import os
 import re
-import shutil
 
+from dataclasses import dataclass
 from pathlib import Path
+from typing import AsyncIterator
 
-from telegram import Update
+from telegram import Audio
 from telegram.ext import CallbackContext
 
+import metrics
 import utils
 import youtube_utils
 
-from message import MsgWrapper
-from settings import get_settings
-from telegram_helpers import (
-    download_audio_file_from_telegram_if_not_in_cache,
-    log_exception_and_notify_chat,
+from artifact_cache import (
+    artifact_key,
+    copy_artifacts,
+    lookup_artifacts,
+    store_artifacts,
 )
-from utils import generate_random_filename_in_cache
+from cache_manager import get_cache_manager
+from message import MsgWrapper
+from scheduler import Job, Stage, get_scheduler
+from singleflight import SingleFlight
+from telegram_helpers import download_audio_file_from_telegram_if_not_in_cache
 
 BANDCAMP_PLAYLIST_PATTERN = re.compile(
     r"^https://[\w\-]+\.bandcamp\.com/album/[\w\-]+$"
@@ -42,110 +46,145 @@ SOUNDCLOUD_PLAYLIST_PATTERNS = re.compile(
 SOUNDCLOUD_SONG_PATTERNS = re.compile(r"^https://soundcloud\.com/[\w\-]+/[\w\-]+$")
 
 
-def _download_song_from_url_if_not_in_cache(
-    link: str, split_chapters: bool
-) -> list[Path]:
-    # if split_chapters is True, then the song will be downloaded and split
-    # into chapters, even if it's already in the cache
-    original_filepath = utils.cache_path_for_mp3_url(link)
-    if split_chapters or not original_filepath.exists():
-        downloaded_songs = youtube_utils.ytdl_download_song(link, split_chapters)
-        if split_chapters:
-            return downloaded_songs
+_song_downloads: SingleFlight[Path] = SingleFlight()
+
+
+async def _download_song_from_url_if_not_in_cache(
+    link: str, need_chapters: bool
+) -> Path:
+    # a link requested again while it is still downloading (by another
+    # message, or twice in one playlist) waits for the running download
+    key = utils.url_signature(link)
+    filepath = await _song_downloads.do(
+        key, lambda: _download_song_from_url(link, need_chapters)
+    )
+    if need_chapters and youtube_utils.load_chapters(filepath) is None:
+        # joined a request that was served from the cache without chapters
+        filepath = await _song_downloads.do(
+            key, lambda: _download_song_from_url(link, need_chapters)
+        )
+    return filepath
 
-        assert downloaded_songs[0].as_posix() == original_filepath.as_posix()
+
+async def _download_song_from_url(link: str, need_chapters: bool) -> Path:
+    # files cached before their chapters were saved along with them are
+    # downloaded again when the chapters are needed
+    original_filepath = utils.cache_path_for_mp3_url(link)
+    chapters_filepath = youtube_utils.chapters_path_for_mp3(original_filepath)
+
+    def is_cached() -> bool:
+        return original_filepath.exists() and (
+            not need_chapters or chapters_filepath.exists()
+        )
+
+    # the file is tagged after it's downloaded, so it's only complete once
+    # the process sharing the cache that downloads it lets go of the lock
+    async with utils.cache_file_lock(original_filepath):
+        cached = is_cached()
+        if not cached:
+            await youtube_utils.ytdl_download_song(link)
+            get_cache_manager().record(original_filepath)
+            get_cache_manager().record(chapters_filepath)
+    metrics.record_cache_lookup("song", cached)
 
     assert original_filepath.exists()
+    get_cache_manager().touch(original_filepath)
+    if chapters_filepath.exists():
+        get_cache_manager().touch(chapters_filepath)
 
-    return [original_filepath]
+    return original_filepath
 
 
-async def download_audio_from_url_if_not_in_cache(
-    update: Update, context: CallbackContext, links: list[str], split_chapters: bool
-) -> list[Path]:
-    link_to_path: dict[str, list[Path]] = {}
-
-    cpu_count = os.cpu_count() or 1
-    max_workers = int(cpu_count * 1.5)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_link = {
-            executor.submit(
-                _download_song_from_url_if_not_in_cache, link, split_chapters
-            ): link
-            for link in links
-        }
-        for future in concurrent.futures.as_completed(future_to_link):
-            try:
-                link_to_path[future_to_link[future]] = future.result()
-            except Exception as exc:
-                await log_exception_and_notify_chat(update, context, exc)
-                raise
-
-    copied_audio_files = []
-
-    for link in links:
-        for chapter_filepath in link_to_path[link]:
-            copy_filepath = generate_random_filename_in_cache(".mp3")
-            shutil.copyfile(chapter_filepath, copy_filepath)
-            copied_audio_files.append(copy_filepath)
-
-    return copied_audio_files
-
-
-async def fetch_parent_message_target(
-    context: CallbackContext, msg: MsgWrapper
+@dataclass
+class Source:
+    # a single thing to process: a link or an audio file sent to telegram;
+    # `key` identifies its content and names its raw file in the cache
+    key: str
+    link: str | None = None
+    audio: Audio | None = None
+
+
+def _copy_to_working_file(filepath: Path) -> Path:
+    copy_filepath = utils.make_working_copy(filepath)
+    get_cache_manager().record(copy_filepath)
+    return copy_filepath
+
+
+async def _split_into_chapters(source_key: str, filepath: Path) -> list[Path]:
+    chapters = youtube_utils.load_chapters(filepath)
+    if not chapters:
+        return [_copy_to_working_file(filepath)]
+
+    key = artifact_key(source_key, {"splitchapters": True})
+    cached_chapters = lookup_artifacts(key, len(chapters))
+    if cached_chapters is not None:
+        return copy_artifacts(cached_chapters)
+
+    with metrics.span("splitchapters", chapters=len(chapters)):
+        chapter_filepaths = await youtube_utils.cut_chapters(filepath, chapters)
+    for chapter_filepath in chapter_filepaths:
+        get_cache_manager().record(chapter_filepath)
+    store_artifacts(key, chapter_filepaths)
+    return chapter_filepaths
+
+
+async def fetch_source(
+    context: CallbackContext, source: Source, split_chapters: bool, job: Job
 ) -> list[Path]:
-    if msg.has_parent and msg.parent_msg.has_audio:
-        audio = msg.parent_msg.audio
-        await download_audio_file_from_telegram_if_not_in_cache(context.bot, audio)
-        original_filepath = get_settings().cache_dir / f"{audio.file_unique_id}.mp3"
-        copy_filepath = generate_random_filename_in_cache(".mp3")
-        shutil.copyfile(original_filepath, copy_filepath)
-        return [copy_filepath]
-    return []
+    async with get_scheduler().slot(Stage.DOWNLOAD, job), metrics.span("fetch"):
+        if source.audio is not None:
+            original_filepath = await download_audio_file_from_telegram_if_not_in_cache(
+                context.bot, source.audio
+            )
+        else:
+            assert source.link is not None
+            original_filepath = await _download_song_from_url_if_not_in_cache(
+                source.link, split_chapters
+            )
+
+    with get_cache_manager().pinned([original_filepath]):
+        if split_chapters and source.link is not None:
+            return await _split_into_chapters(source.key, original_filepath)
+        return [_copy_to_working_file(original_filepath)]
 
 
 async def extract_video_links(
     text: str,
     song_patterns: list[re.Pattern],
     playlist_patterns: list[re.Pattern],
-) -> list[str]:
+) -> AsyncIterator[str]:
     links_in_text = [t for t in text.split() if t.startswith("https")]
 
-    song_links: list[str] = []
     for song_pattern in song_patterns:
-        song_links.extend([p for p in links_in_text if re.match(song_pattern, p)])
+        for link in links_in_text:
+            if re.match(song_pattern, link):
+                yield utils.remove_query_parameter_from_url(link, "list")
 
+    # playlist items are yielded as soon as they are enumerated
     for playlist_pattern in playlist_patterns:
         playlist_links = [p for p in links_in_text if re.match(playlist_pattern, p)]
         for playlist_link in playlist_links:
-            song_links.extend(youtube_utils.playlist_url_to_video_urls(playlist_link))
+            async for url in youtube_utils.iterate_playlist_video_urls(playlist_link):
+                yield utils.remove_query_parameter_from_url(url, "list")
 
-    return [utils.remove_query_parameter_from_url(url, "list") for url in song_links]
 
-
-async def collect_link_targets(text: str) -> list[str]:
+async def collect_link_targets(text: str) -> AsyncIterator[str]:
     patterns_for_services: list[tuple[list[re.Pattern], list[re.Pattern]]] = [
         (YOUTUBE_SONG_PATTERNS, [YOUTUBE_PLAYLIST_PATTERN]),
         ([BANDCAMP_SONG_PATTERN], [BANDCAMP_PLAYLIST_PATTERN]),
         ([SOUNDCLOUD_SONG_PATTERNS], [SOUNDCLOUD_PLAYLIST_PATTERNS]),
     ]
 
-    links = []
     for patterns_for_service in patterns_for_services:
-        links.extend(await extract_video_links(text, *patterns_for_service))
-    return links
-
+        async for link in extract_video_links(text, *patterns_for_service):
+            yield link
 
-async def fetch_targets(
-    update: Update, context: CallbackContext, msg: MsgWrapper, split_chapters: bool
-) -> list[Path]:
-    parent_message_target = await fetch_parent_message_target(context, msg)
-    if parent_message_target:
-        return parent_message_target
 
-    links = await collect_link_targets(msg.text)
+async def collect_sources(msg: MsgWrapper) -> AsyncIterator[Source]:
+    if msg.has_parent and msg.parent_msg.has_audio:
+        audio = msg.parent_msg.audio
+        yield Source(key=audio.file_unique_id, audio=audio)
+        return
 
-    return await download_audio_from_url_if_not_in_cache(
-        update, context, links, split_chapters
-    )
+    async for link in collect_link_targets(msg.text):
+        yield Source(key=utils.url_signature(link), link=link)
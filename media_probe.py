@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import os
+import threading
+
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, cast
+
+import eyed3
+
+import cpu_pool
+import metrics
+
+PROBE_CACHE_MAX_ENTRIES = 128
+
+# (path, inode, size, mtime_ns); any write to the file changes the key
+ProbeKey = tuple[str, int, int, int]
+
+
+@dataclass(frozen=True)
+class MediaProbe:
+    duration: float
+    # title, artist and album, only the ones that are set
+    tags: dict[str, str] = field(default_factory=dict)
+    cover: bytes | None = None
+
+
+_probes: OrderedDict[ProbeKey, MediaProbe] = OrderedDict()
+_probes_lock = threading.Lock()
+
+
+def probe_key(filepath: Path) -> ProbeKey:
+    stat = os.stat(filepath)
+    return (os.path.abspath(filepath), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def _find_cover(tag: Any) -> bytes | None:
+    cover = tag.images.get("Cover (front)")
+    if cover is not None:
+        return cast(bytes, cover.image_data)
+
+    images = list(tag.images)
+    if images:
+        return cast(bytes, images[0].image_data)
+    return None
+
+
+def probe_from_audio_file(audio_file: Any) -> MediaProbe:
+    tag = audio_file.tag
+    if tag is None:
+        return MediaProbe(duration=audio_file.info.time_secs)
+
+    tags = {
+        name: value
+        for name in ("title", "artist", "album")
+        if (value := getattr(tag, name))
+    }
+    return MediaProbe(audio_file.info.time_secs, tags, _find_cover(tag))
+
+
+def remember(filepath: Path, probe: MediaProbe) -> None:
+    key = probe_key(filepath)
+    with _probes_lock:
+        _probes[key] = probe
+        _probes.move_to_end(key)
+        while len(_probes) > PROBE_CACHE_MAX_ENTRIES:
+            _probes.popitem(last=False)
+
+
+def parse(filepath: Path) -> MediaProbe:
+    return probe_from_audio_file(eyed3.load(filepath.as_posix()))
+
+
+async def probe(filepath: Path) -> MediaProbe:
+    # parses the file once, until it's modified; parsing runs in the cpu pool
+    key = probe_key(filepath)
+    with _probes_lock:
+        cached = _probes.get(key)
+        if cached is not None:
+            _probes.move_to_end(key)
+
+    metrics.record_cache_lookup("probe", cached is not None)
+    if cached is not None:
+        return cached
+
+    with metrics.span("probe"):
+        result = await cpu_pool.run_in_cpu_pool(parse, filepath)
+    remember(filepath, result)
+    return result
@@ -0,0 +1,411 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import json
+import math
+import threading
+import time
+
+from collections import defaultdict
+from dataclasses import dataclass, field
+from types import TracebackType
+from typing import Any, Callable, Iterator
+
+from settings import get_default_logger, get_settings
+
+# metrics in the prometheus text format and per-request traces; a trace is
+# carried by a context variable, so the spans of the tasks and threads
+# started while handling a request end up in its trace
+
+# sorted (name, value) pairs
+Labels = tuple[tuple[str, str], ...]
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+)
+
+_metrics_lock = threading.Lock()
+
+
+def _labels(labels: dict[str, str]) -> Labels:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str) -> None:
+        self.name = name
+        self.description = description
+        _REGISTRY.append(self)
+
+    def samples(self) -> list[tuple[str, Labels, float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+_REGISTRY: list[Metric] = []
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str) -> None:
+        super().__init__(name, description)
+        self._values: dict[Labels, float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        with _metrics_lock:
+            self._values[_labels(labels)] += amount
+
+    def value(self, **labels: str) -> float:
+        with _metrics_lock:
+            return self._values.get(_labels(labels), 0.0)
+
+    def samples(self) -> list[tuple[str, Labels, float]]:
+        with _metrics_lock:
+            return [(self.name, labels, v) for labels, v in self._values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, description)
+        self.buckets = buckets
+        # per labels: the count of every bucket, then the sum
+        self._values: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _labels(labels)
+        with _metrics_lock:
+            counts, total = self._values.setdefault(
+                key, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def samples(self) -> list[tuple[str, Labels, float]]:
+        samples: list[tuple[str, Labels, float]] = []
+        with _metrics_lock:
+            for labels, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (math.inf,), counts):
+                    cumulative += count
+                    samples.append(
+                        (
+                            f"{self.name}_bucket",
+                            labels + (("le", _format_value(bound)),),
+                            cumulative,
+                        )
+                    )
+                samples.append((f"{self.name}_sum", labels, total[0]))
+                samples.append((f"{self.name}_count", labels, cumulative))
+        return samples
+
+
+class Gauge(Metric):
+    # read when the metrics are collected
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        collect: Callable[[], list[tuple[dict[str, str], float]]],
+    ) -> None:
+        super().__init__(name, description)
+        self._collect = collect
+
+    def samples(self) -> list[tuple[str, Labels, float]]:
+        return [(self.name, _labels(labels), v) for labels, v in self._collect()]
+
+
+SPAN_SECONDS = Histogram(
+    "mediabot_span_seconds", "Duration of the stages of handling a request."
+)
+REQUEST_SECONDS = Histogram(
+    "mediabot_request_seconds", "Duration of handling a request, end to end."
+)
+SUBPROCESS_SECONDS = Histogram(
+    "mediabot_subprocess_seconds", "Run time of subprocesses, by binary."
+)
+SUBPROCESSES = Counter(
+    "mediabot_subprocesses_total", "Subprocesses run, by binary and result."
+)
+CACHE_LOOKUPS = Counter(
+    "mediabot_cache_lookups_total", "Cache lookups, by cache and result."
+)
+BYTES_MOVED = Counter(
+    "mediabot_bytes_total", "Bytes downloaded and uploaded, by direction."
+)
+
+
+def render_prometheus() -> str:
+    return "\n".join(metric.render() for metric in _REGISTRY) + "\n"
+
+
+@dataclass
+class SpanRecord:
+    name: str
+    # seconds since the start of the trace
+    start: float
+    duration: float
+    attributes: dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class Trace:
+    name: str
+    attributes: dict[str, Any] = field(default_factory=dict)
+    started_at: float = field(default_factory=time.time)
+    duration: float | None = None
+    spans: list[SpanRecord] = field(default_factory=list)
+    counters: dict[str, float] = field(default_factory=lambda: defaultdict(float))
+    _start: float = field(default_factory=time.perf_counter)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._start
+
+    def summary(self) -> dict[str, Any]:
+        # the total time spent in every kind of span, and the spans themselves
+        totals: dict[str, float] = defaultdict(float)
+        for span in self.spans:
+            totals[span.name] += span.duration
+
+        return {
+            "trace": self.name,
+            **self.attributes,
+            "started_at": self.started_at,
+            "duration": self.duration,
+            "span_totals": {k: round(v, 6) for k, v in sorted(totals.items())},
+            "counters": dict(sorted(self.counters.items())),
+            "spans": [
+                {
+                    "name": span.name,
+                    "start": round(span.start, 6),
+                    "duration": round(span.duration, 6),
+                    **span.attributes,
+                }
+                for span in sorted(self.spans, key=lambda s: s.start)
+            ],
+        }
+
+
+_current_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar(
+    "current_trace", default=None
+)
+
+
+def current_trace() -> Trace | None:
+    return _current_trace.get()
+
+
+def _write_trace_summary(trace: Trace) -> None:
+    trace_log = get_settings().trace_log
+    if trace_log is None:
+        return
+
+    try:
+        with open(trace_log, "a") as f:
+            f.write(json.dumps(trace.summary()) + "\n")
+    except OSError as e:
+        get_default_logger().warning("Failed to write the trace summary", exc_info=e)
+
+
+@contextlib.contextmanager
+def trace(name: str, **attributes: Any) -> Iterator[Trace]:
+    # everything measured until the block exits belongs to this trace
+    new_trace = Trace(name, attributes)
+    token = _current_trace.set(new_trace)
+    try:
+        yield new_trace
+    except BaseException as e:
+        new_trace.attributes["error"] = type(e).__name__
+        raise
+    finally:
+        _current_trace.reset(token)
+        new_trace.duration = new_trace.elapsed()
+        REQUEST_SECONDS.observe(new_trace.duration, trace=name)
+        _write_trace_summary(new_trace)
+
+
+class span:
+    # times the block, as a plain or an async context manager; the
+    # attributes it returns can still be filled in by the block
+    def __init__(self, name: str, **attributes: Any) -> None:
+        self.name = name
+        self.attributes = attributes
+        self._trace: Trace | None = None
+        self._started_at = 0.0
+
+    def __enter__(self) -> dict[str, Any]:
+        self._trace = _current_trace.get()
+        self._started_at = time.perf_counter()
+        return self.attributes
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        duration = time.perf_counter() - self._started_at
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+
+        SPAN_SECONDS.observe(duration, span=self.name)
+        if self._trace is not None:
+            start = self._trace.elapsed() - duration
+            with _metrics_lock:
+                self._trace.spans.append(
+                    SpanRecord(self.name, start, duration, self.attributes)
+                )
+
+    async def __aenter__(self) -> dict[str, Any]:
+        return self.__enter__()
+
+    async def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.__exit__(exc_type, exc, traceback)
+
+
+def count_in_trace(name: str, amount: float) -> None:
+    current = _current_trace.get()
+    if current is not None:
+        with _metrics_lock:
+            current.counters[name] += amount
+
+
+def record_cache_lookup(cache: str, hit: bool) -> None:
+    result = "hit" if hit else "miss"
+    CACHE_LOOKUPS.inc(cache=cache, result=result)
+    count_in_trace(f"cache.{cache}.{result}", 1)
+
+
+def record_bytes(direction: str, amount: int) -> None:
+    BYTES_MOVED.inc(amount, direction=direction)
+    count_in_trace(f"bytes.{direction}", amount)
+
+
+def record_subprocess(binary: str, seconds: float, returncode: int | None) -> None:
+    SUBPROCESS_SECONDS.observe(seconds, binary=binary)
+    if returncode == 0:
+        result = "ok"
+    elif returncode is None or returncode < 0:
+        result = "killed"
+    else:
+        result = "error"
+    SUBPROCESSES.inc(binary=binary, result=result)
+
+
+async def _serve_metrics(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 10)
+        # the headers are not needed, but have to be read
+        while (await asyncio.wait_for(reader.readline(), 10)) not in (b"\r\n", b""):
+            pass
+
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1] == "/metrics":
+            status = "200 OK"
+            body = render_prometheus().encode()
+        else:
+            status = "404 Not Found"
+            body = b"not found\n"
+
+        writer.write(
+            (
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode()
+            + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+METRICS_SERVER: asyncio.AbstractServer | None = None
+
+
+async def start_metrics_server() -> None:
+    # serves /metrics on localhost, if a port is configured
+    global METRICS_SERVER
+
+    port = get_settings().metrics_port
+    if port is None or METRICS_SERVER is not None:
+        return
+
+    try:
+        METRICS_SERVER = await asyncio.start_server(_serve_metrics, "127.0.0.1", port)
+    except OSError as e:
+        # e.g. taken by another worker process on this machine
+        get_default_logger().warning(f"Can't serve metrics on port {port}: {e}")
+        return
+    get_default_logger().info(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+
+
+async def stop_metrics_server() -> None:
+    global METRICS_SERVER
+
+    if METRICS_SERVER is not None:
+        METRICS_SERVER.close()
+        await METRICS_SERVER.wait_closed()
+        METRICS_SERVER = None
@@ -1,141 +1,204 @@
 from __future__ import annotations
 
+import asyncio
 import math
 
 from pathlib import Path
-from typing import Any, cast
+from typing import Any, Sequence
 
 import eyed3
+import eyed3.id3.tag
 
-from utils import generate_random_filename_in_cache, run_command, timestamp_to_seconds
+from eyed3.id3 import ID3_V2_3
+from eyed3.id3.frames import ImageFrame
 
+import cpu_pool
+import media_probe
 
-def change_metadata(file: Path, field_name: str, data: str) -> None:
-    temp_filename = generate_random_filename_in_cache("mp3")
+from utils import (
+    bound_to_seconds,
+    ensure_private_copy,
+    generate_random_filename_in_cache,
+    run_command,
+)
 
-    run_command(
-        [
-            "ffmpeg",
-            "-i",
-            file.as_posix(),
-            "-metadata",
-            rf"{field_name}={data}",
-            "-codec",
-            "copy",
-            temp_filename.as_posix(),
-        ],
-    )
-
-    temp_filename.rename(file)
-
-
-def set_cover(filepath: Path, cover_filepath: Path) -> None:
-    # source: https://stackoverflow.com/a/18718265
-
-    temp_filename = generate_random_filename_in_cache("mp3")
-
-    run_command(
-        [
-            "ffmpeg",
-            "-i",
-            filepath.as_posix(),
-            "-i",
-            cover_filepath.as_posix(),
-            "-map",
-            "0:0",
-            "-map",
-            "1:0",
-            "-c",
-            "copy",
-            "-id3v2_version",
-            "3",
-            "-metadata:s:v",
-            "title=Album cover",
-            "-metadata:s:v",
-            "comment=Cover (front)",
-            temp_filename.as_posix(),
-        ],
-    )
+TAG_FIELDS = ("title", "artist", "album")
+ID3_PADDING = 16 * 1024
 
-    temp_filename.rename(filepath)
+# eyed3 reserves this much padding whenever a tag outgrows the space it has
+# in the file, so that subsequent edits can be written in place
+eyed3.id3.tag.DEFAULT_PADDING = ID3_PADDING
 
 
-def read_cover_image(filepath: Path) -> bytes | None:
+def _write_tags(
+    filepath: Path, tags: dict[str, str] | None, cover_filepath: Path | None
+) -> media_probe.MediaProbe:
+    # runs in the cpu pool; the audio is untouched, so the parsed file
+    # describes the result
     audio_file = eyed3.load(filepath.as_posix())
+    tag = audio_file.tag
+    if tag is None:
+        tag = audio_file.initTag(version=ID3_V2_3)
+
+    for field_name, data in (tags or {}).items():
+        assert field_name in TAG_FIELDS, f"Unsupported tag field: {field_name}"
+        setattr(tag, field_name, data)
+
+    if cover_filepath is not None:
+        for image in list(tag.images):
+            tag.images.remove(image.description)
+        tag.images.set(
+            ImageFrame.FRONT_COVER,
+            cover_filepath.read_bytes(),
+            "image/jpeg",
+            "Album cover",
+        )
+
+    tag.save(version=tag.version if tag.version[0] == 2 else ID3_V2_3)
+    return media_probe.probe_from_audio_file(audio_file)
+
+
+async def write_tags(
+    filepath: Path,
+    tags: dict[str, str] | None = None,
+    cover_filepath: Path | None = None,
+) -> None:
+    # rewrites only the ID3v2 tag region, the audio payload is moved only
+    # if the new tag does not fit in the existing one and its padding
+    await asyncio.to_thread(ensure_private_copy, filepath)
+    probe = await cpu_pool.run_in_cpu_pool(_write_tags, filepath, tags, cover_filepath)
+    media_probe.remember(filepath, probe)
+
+
+async def cut_segments(
+    filepath: Path,
+    segments: Sequence[tuple[float, float]],
+    tags: dict[str, str] | None = None,
+    cover_filepath: Path | None = None,
+    segment_tags: list[dict[str, str]] | None = None,
+) -> list[Path]:
+    # produces one file per (start, duration) segment from a single ffmpeg
+    # process; every segment is read through its own seeked input, so there
+    # is no need to decode or re-read the source per output. `segment_tags`
+    # are written to the corresponding output on top of `tags`
+    tags = tags or {}
+    assert segment_tags is None or len(segment_tags) == len(segments)
+
+    temp_cover_file = None
+    if cover_filepath is None:
+        # the attached picture does not survive input seeking, carry it over
+        temp_cover_file = await extract_cover_image(filepath)
+        cover_filepath = temp_cover_file
+
+    cmd = ["ffmpeg"]
+    for start_sec, duration_s in segments:
+        assert duration_s > 0, f"Segment starting at {start_sec}s is empty"
+        cmd += ["-ss", str(start_sec), "-t", str(duration_s)]
+        cmd += ["-i", filepath.as_posix()]
+    if cover_filepath is not None:
+        cmd += ["-i", cover_filepath.as_posix()]
+
+    output_filepaths = [generate_random_filename_in_cache("mp3") for _ in segments]
+
+    for input_idx, output_filepath in enumerate(output_filepaths):
+        cmd += ["-map", f"{input_idx}:a"]
+        if cover_filepath is not None:
+            # source: https://stackoverflow.com/a/18718265
+            cmd += [
+                "-map",
+                f"{len(segments)}:0",
+                "-metadata:s:v",
+                "title=Album cover",
+                "-metadata:s:v",
+                "comment=Cover (front)",
+            ]
+        cmd += ["-c", "copy", "-id3v2_version", "3"]
+        output_tags = {**tags, **(segment_tags[input_idx] if segment_tags else {})}
+        for field_name, data in output_tags.items():
+            cmd += ["-metadata", rf"{field_name}={data}"]
+        cmd.append(output_filepath.as_posix())
 
     try:
-        return cast(bytes, audio_file.tag.images.get("Cover (front)").image_data)
-    except Exception:
-        pass  # not an issue
+        await run_command(cmd)
+    finally:
+        if temp_cover_file is not None:
+            temp_cover_file.unlink()
+
+    return output_filepaths
 
-    images = list(audio_file.tag.images)
-    if images:
-        return cast(bytes, images[0].image_data)
-    else:
-        return None
 
+async def change_metadata(file: Path, field_name: str, data: str) -> None:
+    await write_tags(file, tags={field_name: data})
 
-def copy_cover_image(src: Path, dest: Path) -> None:
-    image = read_cover_image(src)
+
+async def set_cover(filepath: Path, cover_filepath: Path) -> None:
+    await write_tags(filepath, cover_filepath=cover_filepath)
+
+
+async def read_cover_image(filepath: Path) -> bytes | None:
+    return (await media_probe.probe(filepath)).cover
+
+
+async def extract_cover_image(filepath: Path) -> Path | None:
+    image = await read_cover_image(filepath)
     if not image:
-        return
+        return None
 
     temp_cover_file = generate_random_filename_in_cache(".jpg")
-    temp_cover_file.write_bytes(image)
-    set_cover(dest, temp_cover_file)
+    await asyncio.to_thread(temp_cover_file.write_bytes, image)
+    return temp_cover_file
+
+
+async def copy_cover_image(src: Path, dest: Path) -> None:
+    temp_cover_file = await extract_cover_image(src)
+    if temp_cover_file is None:
+        return
+
+    await set_cover(dest, temp_cover_file)
     temp_cover_file.unlink()
 
 
-def read_metadata(filepath: Path) -> dict[str, Any]:
-    audio_file = eyed3.load(filepath.as_posix())
+async def read_metadata(filepath: Path) -> dict[str, Any]:
+    probe = await media_probe.probe(filepath)
 
-    metadata = {
-        "duration": audio_file.info.time_secs,
+    metadata: dict[str, Any] = {
+        "duration": probe.duration,
     }
-    if audio_file.tag.title:
-        metadata["title"] = audio_file.tag.title
-    if audio_file.tag.album:
-        metadata["album"] = audio_file.tag.album
-    if audio_file.tag.artist:
-        metadata["performer"] = audio_file.tag.artist
+    if "title" in probe.tags:
+        metadata["title"] = probe.tags["title"]
+    if "album" in probe.tags:
+        metadata["album"] = probe.tags["album"]
+    if "artist" in probe.tags:
+        metadata["performer"] = probe.tags["artist"]
 
     return metadata
 
 
-def cut_audio(
+async def resolve_segment(
+    filepath: Path, start: str | int, end: str | int, head: int = 0
+) -> tuple[int, int]:
+    # returns (start, duration) in seconds, negative/zero bounds are
+    # relative to the end of the file; the bounds are taken relative to the
+    # file with its first `head` seconds cut off
+    start_sec, end_sec = bound_to_seconds(start), bound_to_seconds(end)
+
+    if start_sec < 0 or end_sec <= 0:
+        duration = math.ceil((await read_metadata(filepath))["duration"]) - head
+        if start_sec < 0:
+            start_sec += duration
+        if end_sec <= 0:
+            end_sec += duration
+
+    return head + start_sec, end_sec - start_sec
+
+
+async def cut_audio(
     filepath: Path, start: str | int, end: str | int, overwrite: bool = True
 ) -> Path:
-    start, end = str(start).strip(), str(end).strip()
-
-    start_sec = timestamp_to_seconds(start) if ":" in start else int(start)
-    end_sec = timestamp_to_seconds(end) if ":" in end else int(end)
-
-    if start_sec < 0:
-        start_sec += math.ceil(read_metadata(filepath)["duration"])
-    if end_sec <= 0:
-        end_sec += math.ceil(read_metadata(filepath)["duration"])
-
-    duration_s = end_sec - start_sec
-
-    temp_filename = generate_random_filename_in_cache("mp3")
-
-    run_command(
-        [
-            "ffmpeg",
-            "-ss",
-            str(start_sec),
-            "-t",
-            str(duration_s),
-            "-i",
-            filepath.as_posix(),
-            "-acodec",
-            "copy",
-            temp_filename.as_posix(),
-        ],
+    [temp_filename] = await cut_segments(
+        filepath, [await resolve_segment(filepath, start, end)]
     )
 
-    copy_cover_image(filepath, temp_filename)
-
     if overwrite:
         temp_filename.rename(filepath)
         return filepath
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import asyncio
+
+from dataclasses import dataclass
+from typing import Any, AsyncIterable, Awaitable, Callable, Generic, TypeVar
+
+T = TypeVar("T")
+
+# an item is tagged with its position in the input, None ends the stream
+_Entry = tuple[int, Any] | None
+
+
+class ReorderBuffer(Generic[T]):
+    # holds results that finished out of order and releases them in the order
+    # of their sequence numbers
+    def __init__(self) -> None:
+        self._next_seq = 0
+        self._pending: dict[int, T] = {}
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def push(self, seq: int, item: T) -> list[T]:
+        self._pending[seq] = item
+        ready = []
+        while self._next_seq in self._pending:
+            ready.append(self._pending.pop(self._next_seq))
+            self._next_seq += 1
+        return ready
+
+
+@dataclass
+class PipelineStage:
+    fn: Callable[[Any], Awaitable[Any]]
+    workers: int
+
+
+async def _feed(
+    items: AsyncIterable[Any], outbox: asyncio.Queue[_Entry], consumers: int
+) -> None:
+    seq = 0
+    async for item in items:
+        await outbox.put((seq, item))
+        seq += 1
+    for _ in range(consumers):
+        await outbox.put(None)
+
+
+async def _work(
+    fn: Callable[[Any], Awaitable[Any]],
+    inbox: asyncio.Queue[_Entry],
+    outbox: asyncio.Queue[_Entry],
+) -> None:
+    while (entry := await inbox.get()) is not None:
+        seq, item = entry
+        await outbox.put((seq, await fn(item)))
+
+
+async def _run_stage(
+    stage: PipelineStage,
+    inbox: asyncio.Queue[_Entry],
+    outbox: asyncio.Queue[_Entry],
+    consumers: int,
+) -> None:
+    await asyncio.gather(
+        *(_work(stage.fn, inbox, outbox) for _ in range(stage.workers))
+    )
+    for _ in range(consumers):
+        await outbox.put(None)
+
+
+async def _drain(
+    inbox: asyncio.Queue[_Entry],
+    sink: Callable[[Any], Awaitable[None]],
+    ordered: bool,
+) -> None:
+    buffer: ReorderBuffer[Any] = ReorderBuffer()
+    while (entry := await inbox.get()) is not None:
+        seq, item = entry
+        for ready_item in buffer.push(seq, item) if ordered else [item]:
+            await sink(ready_item)
+
+
+async def run_pipeline(
+    items: AsyncIterable[Any],
+    stages: list[PipelineStage],
+    sink: Callable[[Any], Awaitable[None]],
+    ordered: bool = True,
+    sink_buffer_size: int = 1,
+) -> None:
+    # every item moves through the stages on its own; the queues between the
+    # stages are bounded, so a slow stage holds back the ones before it. The
+    # sink gets the items in input order if `ordered`, otherwise as they come.
+    # The first failure cancels the whole pipeline and is raised.
+    queues: list[asyncio.Queue[_Entry]] = [
+        asyncio.Queue(maxsize=stage.workers) for stage in stages
+    ]
+    queues.append(asyncio.Queue(maxsize=sink_buffer_size))
+
+    consumers = [stage.workers for stage in stages] + [1]
+    tasks = [asyncio.create_task(_feed(items, queues[0], consumers[0]))]
+    for i, stage in enumerate(stages):
+        tasks.append(
+            asyncio.create_task(
+                _run_stage(stage, queues[i], queues[i + 1], consumers[i + 1])
+            )
+        )
+    tasks.append(asyncio.create_task(_drain(queues[-1], sink, ordered)))
+
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
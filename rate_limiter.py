@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+from typing import Awaitable, Callable, TypeVar
+
+import telegram.error
+
+import metrics
+
+from settings import get_default_logger
+
+T = TypeVar("T")
+
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_MESSAGES_PER_SECOND = 30.0
+PRIVATE_CHAT_MESSAGES_PER_SECOND = 1.0
+GROUP_CHAT_MESSAGES_PER_SECOND = 20 / 60
+# a whole media group may go out at once
+CHAT_BURST_MESSAGES = 10
+
+MAX_TRACKED_CHATS = 1000
+MAX_RETRY_AFTER_ATTEMPTS = 5
+
+
+class TokenBucket:
+    # `rate` tokens per second, at most `capacity` saved up; a request for
+    # more tokens than the capacity waits for a full bucket and goes into debt
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - max(self._updated_at, self._blocked_until)
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated_at = now
+
+    @property
+    def is_full(self) -> bool:
+        self._refill()
+        return self._tokens >= self.capacity
+
+    def block(self, seconds: float) -> None:
+        # nothing is handed out for `seconds`, afterwards a single message may
+        # go right away and the rest waits for the bucket to refill
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = min(self._tokens, 1)
+
+    async def acquire(self, tokens: float = 1) -> None:
+        # waiters are served in arrival order
+        async with self._lock:
+            while True:
+                self._refill()
+                now = time.monotonic()
+                wait = max(
+                    self._blocked_until - now,
+                    (min(tokens, self.capacity) - self._tokens) / self.rate,
+                )
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self._tokens -= tokens
+
+
+class TelegramRateLimiter:
+    def __init__(self) -> None:
+        self._global = TokenBucket(
+            GLOBAL_MESSAGES_PER_SECOND, GLOBAL_MESSAGES_PER_SECOND
+        )
+        self._chats: dict[int, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_TRACKED_CHATS:
+                # a full bucket behaves exactly like a new one
+                self._chats = {c: b for c, b in self._chats.items() if not b.is_full}
+            # group and channel ids are negative
+            rate = (
+                PRIVATE_CHAT_MESSAGES_PER_SECOND
+                if chat_id > 0
+                else GROUP_CHAT_MESSAGES_PER_SECOND
+            )
+            bucket = self._chats[chat_id] = TokenBucket(rate, CHAT_BURST_MESSAGES)
+        return bucket
+
+    async def acquire(self, chat_id: int, messages: int = 1) -> None:
+        await self._chat_bucket(chat_id).acquire(messages)
+        await self._global.acquire(messages)
+
+    async def call(
+        self, chat_id: int, messages: int, fn: Callable[[], Awaitable[T]]
+    ) -> T:
+        # sends within the limits; a flood error pauses the chat for as long
+        # as telegram asks and the request is retried
+        for attempt in range(1, MAX_RETRY_AFTER_ATTEMPTS + 1):
+            with metrics.span("rate_limit_wait"):
+                await self.acquire(chat_id, messages)
+            try:
+                return await fn()
+            except telegram.error.RetryAfter as e:
+                if attempt == MAX_RETRY_AFTER_ATTEMPTS:
+                    raise
+                get_default_logger().warning(
+                    f"Flood limit hit in chat {chat_id}, "
+                    f"retrying in {e.retry_after} seconds"
+                )
+                self._chat_bucket(chat_id).block(e.retry_after)
+
+        raise AssertionError("unreachable")
+
+
+RATE_LIMITER: TelegramRateLimiter | None = None
+
+
+def get_rate_limiter() -> TelegramRateLimiter:
+    global RATE_LIMITER
+
+    if RATE_LIMITER is None:
+        RATE_LIMITER = TelegramRateLimiter()
+
+    return RATE_LIMITER
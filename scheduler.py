@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import enum
+import heapq
+import itertools
+import os
+
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, Hashable
+
+import metrics
+
+
+class Stage(enum.Enum):
+    DOWNLOAD = "download"
+    TRANSFORM = "transform"
+    UPLOAD = "upload"
+
+
+DEFAULT_STAGE_SLOTS = {
+    Stage.DOWNLOAD: 4,
+    Stage.TRANSFORM: os.cpu_count() or 1,
+    Stage.UPLOAD: 4,
+}
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+
+# jobs with more items than this are scheduled after the interactive ones
+INTERACTIVE_JOB_MAX_ITEMS = 3
+
+
+def job_priority(items_count: int) -> int:
+    if items_count <= INTERACTIVE_JOB_MAX_ITEMS:
+        return PRIORITY_INTERACTIVE
+    return PRIORITY_BATCH
+
+
+@dataclass(eq=False)
+class Job:
+    owner: Hashable
+    priority: int = PRIORITY_INTERACTIVE
+    # called once, the first time an item of the job has to wait for a slot
+    # held or queued for by another job; gets the number of other jobs ahead
+    on_queued: Callable[[int], Awaitable[None]] | None = None
+    queued_notified: bool = field(default=False, init=False)
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: int
+    turn: int
+    seq: int
+    owner: Hashable = field(compare=False)
+    future: asyncio.Future[None] = field(compare=False)
+
+
+class FairLimiter:
+    # a bounded pool of slots; within a priority level the waiting owners
+    # are served round-robin, so one owner's 200 items do not starve others
+    def __init__(self, slots: int) -> None:
+        assert slots > 0
+        self.slots = slots
+        self._free = slots
+        self._holders: Counter[Hashable] = Counter()
+        self._waiters: list[_Waiter] = []
+        self._owner_turns: dict[Hashable, int] = {}
+        self._virtual_turn = 0
+        self._seq = itertools.count()
+
+    @property
+    def busy(self) -> int:
+        return self.slots - self._free
+
+    @property
+    def depth(self) -> int:
+        return sum(1 for w in self._waiters if not w.future.done())
+
+    def position(self, owner: Hashable) -> int | None:
+        # the number of other owners waiting ahead of the owner's first item
+        ahead: set[Hashable] = set()
+        for waiter in sorted(w for w in self._waiters if not w.future.done()):
+            if waiter.owner == owner:
+                return len(ahead)
+            ahead.add(waiter.owner)
+        return None
+
+    def _behind_others(self, owner: Hashable) -> bool:
+        # whether the owner waits for anything but its own items
+        if any(holder != owner for holder in self._holders):
+            return True
+        return bool(self.position(owner))
+
+    async def acquire(self, job: Job) -> None:
+        if self._free > 0 and self.depth == 0:
+            self._free -= 1
+            self._holders[job.owner] += 1
+            return
+
+        turn = max(self._owner_turns.get(job.owner, 0), self._virtual_turn) + 1
+        self._owner_turns[job.owner] = turn
+        waiter = _Waiter(
+            priority=job.priority,
+            turn=turn,
+            seq=next(self._seq),
+            owner=job.owner,
+            future=asyncio.get_running_loop().create_future(),
+        )
+        heapq.heappush(self._waiters, waiter)
+
+        try:
+            if (
+                job.on_queued is not None
+                and not job.queued_notified
+                and self._behind_others(job.owner)
+            ):
+                job.queued_notified = True
+                await job.on_queued(self.position(job.owner) or 0)
+            await waiter.future
+        except BaseException:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # the slot was handed over just before the cancellation
+                self.release(job.owner)
+            else:
+                waiter.future.cancel()
+            raise
+
+    def release(self, owner: Hashable) -> None:
+        self._holders[owner] -= 1
+        if self._holders[owner] <= 0:
+            del self._holders[owner]
+
+        while self._waiters:
+            waiter = heapq.heappop(self._waiters)
+            if not waiter.future.done():
+                self._virtual_turn = waiter.turn
+                self._holders[waiter.owner] += 1
+                waiter.future.set_result(None)
+                return
+
+        self._free += 1
+        self._owner_turns.clear()
+
+
+class JobScheduler:
+    def __init__(self, stage_slots: dict[Stage, int]) -> None:
+        self._limiters = {
+            stage: FairLimiter(slots) for stage, slots in stage_slots.items()
+        }
+
+    @contextlib.asynccontextmanager
+    async def slot(self, stage: Stage, job: Job) -> AsyncIterator[None]:
+        limiter = self._limiters[stage]
+        with metrics.span(f"queue.{stage.value}"):
+            await limiter.acquire(job)
+        try:
+            yield
+        finally:
+            limiter.release(job.owner)
+
+    def queue_depth(self, stage: Stage) -> int:
+        return self._limiters[stage].depth
+
+    def busy_slots(self, stage: Stage) -> int:
+        return self._limiters[stage].busy
+
+    def queue_position(self, stage: Stage, owner: Hashable) -> int | None:
+        return self._limiters[stage].position(owner)
+
+
+SCHEDULER: JobScheduler | None = None
+
+
+def get_scheduler() -> JobScheduler:
+    global SCHEDULER
+
+    if SCHEDULER is None:
+        SCHEDULER = JobScheduler(DEFAULT_STAGE_SLOTS)
+
+    return SCHEDULER
+
+
+metrics.Gauge(
+    "mediabot_queue_depth",
+    "Items waiting for a slot, by stage.",
+    lambda: (
+        []
+        if SCHEDULER is None
+        else [({"stage": s.value}, SCHEDULER.queue_depth(s)) for s in Stage]
+    ),
+)
+metrics.Gauge(
+    "mediabot_busy_slots",
+    "Slots in use, by stage.",
+    lambda: (
+        []
+        if SCHEDULER is None
+        else [({"stage": s.value}, SCHEDULER.busy_slots(s)) for s in Stage]
+    ),
+)
@@ -1,17 +1,33 @@
 import json
 import logging
+import os
+import threading
+import time
 
 from pathlib import Path
 
+CONFIG_FILENAME = "config.json"
+RELOAD_CHECK_INTERVAL_SECONDS = 2.0
+
 
 class Settings:
+    # an immutable snapshot of the config file, see get_settings
     token: str
     log_file: Path
-    authorized_users: list[int]
-    authorized_chats: list[int]
+    authorized_users: frozenset[int]
+    authorized_chats: frozenset[int]
     authorize_all: bool
     cache_dir: Path
     cache_timeout_seconds: int
+    cache_max_bytes: int | None
+    file_id_index: Path
+    ordered_delivery: bool
+    metrics_port: int | None
+    trace_log: Path | None
+    bot_api_url: str | None
+    bot_api_file_url: str | None
+    job_queue: Path
+    worker_jobs: int
 
     def __init__(self, filename: str) -> None:
         with open(filename) as f:
@@ -22,20 +38,80 @@ class Settings:
         self.log_file = Path(filecontents["log_file"])
         self.log_file.touch(exist_ok=True)
 
-        self.authorized_users = filecontents["allowed_users"]
-        self.authorized_chats = filecontents["allowed_groups"]
+        self.authorized_users = frozenset(filecontents["allowed_users"])
+        self.authorized_chats = frozenset(filecontents["allowed_groups"])
         self.authorize_all = (
             len(self.authorized_users) == len(self.authorized_chats) == 0
         )
 
         self.cache_timeout_seconds = int(filecontents["cache_timeout_minutes"]) * 60
+        cache_max_megabytes = filecontents.get("cache_max_megabytes")
+        self.cache_max_bytes = (
+            int(cache_max_megabytes) * 1_000_000 if cache_max_megabytes else None
+        )
         self.cache_dir = Path(filecontents["cache_dir"])
         if not self.cache_dir.is_dir():
             self.cache_dir.mkdir(parents=True)
 
+        self.file_id_index = Path(filecontents.get("file_id_index", "file_ids.sqlite3"))
+        self.ordered_delivery = bool(filecontents.get("ordered_delivery", True))
+
+        metrics_port = filecontents.get("metrics_port")
+        self.metrics_port = int(metrics_port) if metrics_port else None
+        trace_log = filecontents.get("trace_log")
+        self.trace_log = Path(trace_log) if trace_log else None
+
+        # a self-hosted bot api server, or a stand-in for load tests
+        self.bot_api_url = filecontents.get("bot_api_url") or None
+        self.bot_api_file_url = filecontents.get("bot_api_file_url") or None
+
+        self.job_queue = Path(filecontents.get("job_queue", "jobs.sqlite3"))
+        self.worker_jobs = int(filecontents.get("worker_jobs", 4))
+
+
+SETTINGS: Settings | None = None
+_settings_mtime_ns = 0
+_settings_checked_at = 0.0
+_settings_lock = threading.Lock()
+
+
+def _is_reload_check_due() -> bool:
+    return (
+        SETTINGS is None
+        or time.monotonic() - _settings_checked_at >= RELOAD_CHECK_INTERVAL_SECONDS
+    )
+
 
 def get_settings() -> Settings:
-    return Settings("config.json")
+    # the config is parsed once and reloaded when the file changes; the file
+    # is checked at most once per RELOAD_CHECK_INTERVAL_SECONDS
+    global SETTINGS, _settings_mtime_ns, _settings_checked_at
+
+    if not _is_reload_check_due():
+        assert SETTINGS is not None
+        return SETTINGS
+
+    with _settings_lock:
+        if _is_reload_check_due():
+            _settings_checked_at = time.monotonic()
+            mtime_ns = os.stat(CONFIG_FILENAME).st_mtime_ns
+
+            if SETTINGS is None:
+                SETTINGS = Settings(CONFIG_FILENAME)
+            elif mtime_ns != _settings_mtime_ns:
+                try:
+                    SETTINGS = Settings(CONFIG_FILENAME)
+                except Exception as e:
+                    # keep serving the previous snapshot until the file is fixed
+                    logging.getLogger("mediabot_logger").error(
+                        "Failed to reload settings", exc_info=e
+                    )
+                else:
+                    logging.getLogger("mediabot_logger").info("Settings reloaded")
+            _settings_mtime_ns = mtime_ns
+
+        assert SETTINGS is not None
+        return SETTINGS
 
 
 LOGGER = None
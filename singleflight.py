@@ -0,0 +1,32 @@
+from __future__ import annotations
+
+import asyncio
+
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight(Generic[T]):
+    # concurrent calls with the same key share a single execution; callers
+    # that arrive while it is running await its result instead of redoing it
+    def __init__(self) -> None:
+        self._in_flight: dict[Hashable, asyncio.Future[T]] = {}
+
+    def is_in_flight(self, key: Hashable) -> bool:
+        return key in self._in_flight
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self._in_flight[key] = future
+
+            def forget(done: asyncio.Future[T]) -> None:
+                if self._in_flight.get(key) is done:
+                    del self._in_flight[key]
+
+            future.add_done_callback(forget)
+
+        # a cancelled caller must not cancel the work the others wait for
+        return await asyncio.shield(future)
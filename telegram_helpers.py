@@ -1,41 +1,146 @@
 from __future__ import annotations
 
+import asyncio
 import os
 import traceback
 
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable, Sequence, cast
 
-from telegram import Audio, Bot, InlineKeyboardMarkup, Update
+import httpx
+
+from telegram import Audio, Bot, InlineKeyboardMarkup, InputMediaAudio, Update
 from telegram.ext import CallbackContext
 
+import metrics
 import mp3_utils
 
+from cache_manager import get_cache_manager
 from message import MsgWrapper
+from rate_limiter import get_rate_limiter
 from settings import get_default_logger, get_settings
+from singleflight import SingleFlight
+from utils import cache_file_lock
 
 EMPTY_MSG = "\xad\xad"
 
 
 TELEGRAM_BOT_MAX_FILE_SIZE = 50_000_000  # 50 MB
+MEDIA_GROUP_MAX_SIZE = 10
+
+UPLOAD_TIMEOUTS: dict[str, Any] = {
+    "write_timeout": 60,
+    "read_timeout": 60,
+    "pool_timeout": 60,
+    "connect_timeout": 60,
+}
+
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+DOWNLOAD_TIMEOUT_SECONDS = 60
+
+# called with (downloaded bytes, total bytes if known)
+DownloadProgressCallback = Callable[[int, int | None], None]
+
+_telegram_downloads: SingleFlight[Path] = SingleFlight()
+# the progress of a shared download is reported to all its callers
+_progress_callbacks: dict[str, list[DownloadProgressCallback]] = {}
 
 
 async def download_file_from_telegram_if_not_in_cache(
-    bot: Bot, file_id: str, file_unique_id: str, ext: str
+    bot: Bot,
+    file_id: str,
+    file_unique_id: str,
+    ext: str,
+    on_progress: DownloadProgressCallback | None = None,
 ) -> Path:
     assert not ext.startswith(".")
     path = get_settings().cache_dir / f"{file_unique_id}.{ext}"
-    if not path.exists():
-        path.write_bytes(await download_file_from_telegram(bot, file_id))
-    return path
+    metrics.record_cache_lookup("telegram_file", path.exists())
+    if path.exists():
+        get_cache_manager().touch(path)
+        return path
+
+    def report_progress(downloaded_size: int, total_size: int | None) -> None:
+        for callback in list(_progress_callbacks.get(file_unique_id, [])):
+            callback(downloaded_size, total_size)
+
+    async def download() -> Path:
+        # the partial file is shared with other processes using the cache
+        async with cache_file_lock(path):
+            if not path.exists():
+                with metrics.span("download.telegram"):
+                    await download_file_from_telegram(
+                        bot, file_id, path, report_progress
+                    )
+        get_cache_manager().record(path)
+        return path
+
+    if on_progress is None:
+        return await _telegram_downloads.do(file_unique_id, download)
+
+    callbacks = _progress_callbacks.setdefault(file_unique_id, [])
+    callbacks.append(on_progress)
+    try:
+        return await _telegram_downloads.do(file_unique_id, download)
+    finally:
+        callbacks.remove(on_progress)
+        if not callbacks and _progress_callbacks.get(file_unique_id) is callbacks:
+            del _progress_callbacks[file_unique_id]
 
 
-async def download_file_from_telegram(bot: Bot, file_id: str) -> bytes:
+async def download_file_from_telegram(
+    bot: Bot,
+    file_id: str,
+    path: Path,
+    on_progress: DownloadProgressCallback | None = None,
+) -> None:
+    # streams the file into `<path>.part` in bounded chunks and renames it once
+    # complete; a partial file left by an interrupted download is resumed
     file_data = await bot.get_file(file_id)
+    assert file_data.file_path is not None
+    total_size = file_data.file_size
+
+    part_path = path.with_name(path.name + ".part")
+    downloaded_size = part_path.stat().st_size if part_path.exists() else 0
+
+    if total_size is None or downloaded_size < total_size:
+        headers = {"Range": f"bytes={downloaded_size}-"} if downloaded_size else {}
+        try:
+            async with httpx.AsyncClient(timeout=DOWNLOAD_TIMEOUT_SECONDS) as client:
+                async with client.stream(
+                    "GET", file_data.file_path, headers=headers
+                ) as response:
+                    response.raise_for_status()
+                    if response.status_code != httpx.codes.PARTIAL_CONTENT:
+                        # the range was ignored, the whole file is being sent
+                        downloaded_size = 0
+
+                    with open(part_path, "ab" if downloaded_size else "wb") as f:
+                        async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                            f.write(chunk)
+                            downloaded_size += len(chunk)
+                            metrics.record_bytes("download", len(chunk))
+                            if on_progress is not None:
+                                on_progress(downloaded_size, total_size)
+        except httpx.HTTPStatusError as e:
+            # the errors of httpx name the url of the file, which contains
+            # the bot token, and errors are posted to the chat
+            raise RuntimeError(
+                f"Downloading {file_id} failed with status {e.response.status_code}"
+            ) from None
+        except httpx.HTTPError as e:
+            raise RuntimeError(
+                f"Downloading {file_id} failed: {type(e).__name__}"
+            ) from None
+
+    if total_size is not None and downloaded_size != total_size:
+        # the partial file doesn't match the file, it is downloaded anew
+        part_path.unlink(missing_ok=True)
+        raise RuntimeError(
+            f"Downloaded {downloaded_size} bytes of {file_id}, expected {total_size}"
+        )
 
-    buffer = bytearray()
-    await file_data.download_as_bytearray(buffer)
-    return bytes(buffer)
+    os.replace(part_path, path)
 
 
 async def send_message(
@@ -87,14 +192,9 @@ async def send_reply(
     return reply_msg
 
 
-async def send_reply_audio(
-    update: Update,
-    audio: Path,
-    thumbnail: str | bytes | None = None,
-    **kwargs: Any,
-) -> MsgWrapper:
-    assert update.message is not None
-
+async def audio_upload_metadata(
+    audio: Path, thumbnail: str | bytes | None = None
+) -> dict[str, Any]:
     filesize = os.path.getsize(audio)
     if filesize > TELEGRAM_BOT_MAX_FILE_SIZE:
         raise ValueError(
@@ -102,36 +202,96 @@ async def send_reply_audio(
             f"of 50 MB (has {filesize/1_000_000} mb)"
         )
 
-    metadata = mp3_utils.read_metadata(audio)
+    metadata = await mp3_utils.read_metadata(audio)
 
-    if "title" in metadata:
-        metadata["filename"] = metadata["title"]
+    # the contents are attached as bytes, which carry no name of their own
+    metadata["filename"] = metadata.get("title", audio.name)
 
     if thumbnail is None:
-        thumbnail = mp3_utils.read_cover_image(audio)
+        thumbnail = await mp3_utils.read_cover_image(audio)
     if thumbnail:
         metadata["thumbnail"] = thumbnail
 
-    metadata = {
+    return {
         k: v
         for k, v in metadata.items()
         if k in ("title", "performer", "thumbnail", "filename", "duration")
     }
 
+
+async def read_upload(audio: Path) -> bytes:
+    # the library would read the file on the event loop, up to 50 MB of it
+    return await asyncio.to_thread(audio.read_bytes)
+
+
+async def send_reply_audio(
+    update: Update,
+    audio: Path,
+    thumbnail: str | bytes | None = None,
+    **kwargs: Any,
+) -> MsgWrapper:
+    assert update.message is not None
+
     return MsgWrapper(
-        # TODO reply media group
         await update.message.reply_audio(
-            audio=audio,
-            **metadata,
-            write_timeout=60,
-            read_timeout=60,
-            pool_timeout=60,
-            connect_timeout=60,
+            audio=await read_upload(audio),
+            **await audio_upload_metadata(audio, thumbnail),
+            **UPLOAD_TIMEOUTS,
             **kwargs,
         )
     )
 
 
+async def send_reply_audio_group(
+    update: Update, media: list[InputMediaAudio]
+) -> list[MsgWrapper]:
+    assert update.message is not None
+    assert 2 <= len(media) <= MEDIA_GROUP_MAX_SIZE
+
+    sent_msgs = await update.message.reply_media_group(media=media, **UPLOAD_TIMEOUTS)
+    return [MsgWrapper(msg) for msg in sent_msgs]
+
+
+async def send_audios(update: Update, audios: Sequence[Path | str]) -> list[str]:
+    # `audios` are local files or file ids of already uploaded files; up to
+    # MEDIA_GROUP_MAX_SIZE of them are sent as one album. Returns the file ids.
+    assert len(audios) <= MEDIA_GROUP_MAX_SIZE
+    chat_id = MsgWrapper(update.message).chat_id
+
+    async def send() -> list[MsgWrapper]:
+        if len(audios) == 1:
+            audio = audios[0]
+            if isinstance(audio, Path):
+                return [await send_reply_audio(update, audio)]
+            return [await send_reply_cached_audio(update, audio)]
+
+        # input media turn paths into file:// uris, which only a local bot
+        # api server accepts, so the contents are attached instead
+        media = [
+            (
+                InputMediaAudio(
+                    await read_upload(audio), **await audio_upload_metadata(audio)
+                )
+                if isinstance(audio, Path)
+                else InputMediaAudio(audio)
+            )
+            for audio in audios
+        ]
+        return await send_reply_audio_group(update, media)
+
+    uploaded_bytes = sum(a.stat().st_size for a in audios if isinstance(a, Path))
+    with metrics.span("upload", files=len(audios), bytes=uploaded_bytes):
+        sent_msgs = await get_rate_limiter().call(chat_id, len(audios), send)
+    metrics.record_bytes("upload", uploaded_bytes)
+    return [cast(str, msg.audio.file_id) for msg in sent_msgs]
+
+
+async def send_reply_cached_audio(update: Update, file_id: str) -> MsgWrapper:
+    assert update.message is not None
+
+    return MsgWrapper(await update.message.reply_audio(audio=file_id))
+
+
 async def log_exception_and_notify_chat(
     update: Update, context: CallbackContext, exc: Exception
 ) -> None:
@@ -143,19 +303,8 @@ async def log_exception_and_notify_chat(
 
 
 async def download_audio_file_from_telegram_if_not_in_cache(
-    bot: Bot, audio: Audio
+    bot: Bot, audio: Audio, on_progress: DownloadProgressCallback | None = None
 ) -> Path:
     return await download_file_from_telegram_if_not_in_cache(
-        bot, audio.file_id, audio.file_unique_id, "mp3"
+        bot, audio.file_id, audio.file_unique_id, "mp3", on_progress
     )
-
-
-async def post_audio_to_telegram(
-    update: Update, context: CallbackContext, audio_filepath: Path
-) -> None:
-    await send_reply_audio(update, audio_filepath)
-    # ret = await send_reply_audio(update, audio_filepath)
-    # return await download_audio_file_from_telegram_if_not_in_cache(
-    #    context.bot, ret.audio
-    # )
-    return None
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+import metrics
+import mp3_utils
+
+from artifact_cache import (
+    artifact_key,
+    copy_artifacts,
+    lookup_artifacts,
+    store_artifacts,
+)
+from cover_store import get_cover_for_url
+from utils import bound_to_seconds, url_signature
+
+METADATA_TRANSFORMERS = ("title", "artist", "album")
+LENGTH_TRANSFORMERS = ("cut", "cuthead", "splitchapters")
+GENERAL_TRANSFORMERS = ("cover", "replacetitle")
+TRANSFORMERS = METADATA_TRANSFORMERS + LENGTH_TRANSFORMERS + GENERAL_TRANSFORMERS
+
+DEFAULT_CUTHEAD_SECONDS = 5
+
+
+@dataclass
+class TransformPlan:
+    # all transformers of a message folded into one ffmpeg pass for the length
+    # transformers followed by one in-place tag edit; `cuthead` fans the
+    # result out into several outputs of that pass. Like the transformers of
+    # a message, `cut` and `cuthead` apply in the order they were given: the
+    # cut is applied to the source, or to every head-cut output if
+    # `cuthead_first`
+    tags: dict[str, str] = field(default_factory=dict)
+    title_replacements: list[tuple[str, str]] = field(default_factory=list)
+    cover_url: str | None = None
+    # in seconds, so that equal cuts are spelled the same
+    cut: tuple[int, int] | None = None
+    cuthead: int | None = None
+    cuthead_first: bool = False
+
+
+def parse_title_replacement(args: list[str]) -> tuple[str, str]:
+    # format: replacetitle a;b
+    arg = " ".join(args).strip()
+    if arg.endswith(";"):
+        return arg.strip(";"), ""
+
+    old_part, new_part = arg.split(";")
+    return old_part, new_part
+
+
+def replace_in_title(title: str, replacements: list[tuple[str, str]]) -> str:
+    for old_part, new_part in replacements:
+        title = title.replace(old_part, new_part).strip()
+    return title
+
+
+def compile_plan(transformers: dict[str, list[list[str]]]) -> TransformPlan:
+    plan = TransformPlan()
+
+    for name, args_lst in transformers.items():
+        if name in METADATA_TRANSFORMERS:
+            assert len(args_lst) == 1, f"{name} can only be used once"
+            plan.tags[name] = " ".join(args_lst[0])
+            if name == "title":
+                plan.title_replacements.clear()
+        elif name == "cover":
+            assert len(args_lst) == 1, f"cover can only be used once, {args_lst}"
+            plan.cover_url = args_lst[-1][0]
+        elif name == "replacetitle":
+            replacements = [parse_title_replacement(args) for args in args_lst]
+            if "title" in plan.tags:
+                plan.tags["title"] = replace_in_title(plan.tags["title"], replacements)
+            else:
+                plan.title_replacements.extend(replacements)
+        elif name == "cut":
+            assert len(args_lst) == 1, "cut can only be used once"
+            start, end = args_lst[-1]
+            plan.cut = (bound_to_seconds(start), bound_to_seconds(end))
+            plan.cuthead_first = plan.cuthead is not None
+        elif name == "cuthead":
+            assert len(args_lst) == 1, "cuthead can only be used once"
+            args = args_lst[0]
+            assert len(args) <= 1, "Too many arguments for cuthead (expected 0 or 1)"
+            plan.cuthead = int(args[0]) if args else DEFAULT_CUTHEAD_SECONDS
+        elif name == "splitchapters":
+            # already done elsewhere
+            pass
+        else:
+            raise Exception("Unknown transformer name: " + name)
+
+    return plan
+
+
+def canonical_spec(transformers: dict[str, list[list[str]]]) -> str:
+    # equal for all transformer lists that produce the same result,
+    # regardless of how they were ordered or spelled in the message
+    plan = asdict(compile_plan(transformers))
+    if plan["cover_url"] is not None:
+        # the spec is stored in the file id index, and the urls of telegram
+        # files contain the bot token
+        plan["cover_url"] = url_signature(plan["cover_url"])
+    return json.dumps(
+        {
+            "plan": plan,
+            "splitchapters": "splitchapters" in transformers,
+        },
+        sort_keys=True,
+    )
+
+
+async def resolve_tags(filepath: Path, plan: TransformPlan) -> dict[str, str]:
+    tags = dict(plan.tags)
+    if plan.title_replacements:
+        title = (await mp3_utils.read_metadata(filepath))["title"]
+        tags["title"] = replace_in_title(title, plan.title_replacements)
+    return tags
+
+
+async def apply_length_transformers(
+    filepath: Path, plan: TransformPlan, source_key: str | None
+) -> list[Path]:
+    if plan.cut is None and plan.cuthead is None:
+        return [filepath]
+
+    # the cut outputs do not depend on any tag transformer, so they can be
+    # shared by all requests with the same source, cut and cuthead
+    outputs_count = plan.cuthead or 1
+    key = None
+    if source_key is not None:
+        key = artifact_key(
+            source_key,
+            {
+                "cut": plan.cut,
+                "cuthead": plan.cuthead,
+                "cuthead_first": plan.cuthead_first,
+            },
+        )
+        cached_artifacts = lookup_artifacts(key, outputs_count)
+        if cached_artifacts is not None:
+            filepath.unlink()
+            return copy_artifacts(cached_artifacts)
+
+    # every head-cut variant is a separate output of the same ffmpeg run
+    cut = plan.cut or (0, 0)
+    if plan.cuthead is None:
+        segments = [await mp3_utils.resolve_segment(filepath, *cut)]
+    elif plan.cuthead_first:
+        segments = [
+            await mp3_utils.resolve_segment(filepath, *cut, head=i)
+            for i in range(1, outputs_count + 1)
+        ]
+    else:
+        start_sec, duration_s = await mp3_utils.resolve_segment(filepath, *cut)
+        segments = [
+            (start_sec + i, duration_s - i) for i in range(1, outputs_count + 1)
+        ]
+
+    with metrics.span("transform.cut", outputs=outputs_count):
+        filepaths = await mp3_utils.cut_segments(filepath, segments)
+    filepath.unlink()
+
+    if key is not None:
+        store_artifacts(key, filepaths)
+    return filepaths
+
+
+async def execute_plan(
+    filepath: Path, plan: TransformPlan, source_key: str | None = None
+) -> list[Path]:
+    tags = await resolve_tags(filepath, plan)
+    cover_filepath = await get_cover_for_url(plan.cover_url) if plan.cover_url else None
+
+    filepaths = await apply_length_transformers(filepath, plan, source_key)
+
+    if tags or cover_filepath:
+        # tag changes never need to touch the audio stream
+        # the outputs are tagged in parallel, in the cpu pool
+        with metrics.span("transform.tags", outputs=len(filepaths)):
+            await asyncio.gather(
+                *(
+                    mp3_utils.write_tags(
+                        output_filepath, tags=tags, cover_filepath=cover_filepath
+                    )
+                    for output_filepath in filepaths
+                )
+            )
+
+    return filepaths
@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import asyncio
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Awaitable, Callable, Sequence
+
+from telegram_helpers import MEDIA_GROUP_MAX_SIZE
+
+# how long a partial album waits for the files of the next items
+UPLOAD_LINGER_SECONDS = 1.0
+
+# a local file or the file id of a file uploaded before
+Media = Path | str
+
+
+@dataclass(eq=False)
+class _Upload:
+    files: Sequence[Media]
+    # called with the file ids of all the files, in order
+    on_uploaded: Callable[[list[str]], Awaitable[None]]
+    file_ids: dict[int, str] = field(default_factory=dict)
+
+
+class UploadBatcher:
+    # packs the files of consecutive items into albums of up to
+    # MEDIA_GROUP_MAX_SIZE files. A partial album is sent `linger_seconds`
+    # after its first file was added, or by `flush`. With `max_in_flight` > 1
+    # albums are sent concurrently and may arrive out of order, otherwise they
+    # are sent one at a time and `flush` waits for the album to be sent.
+    def __init__(
+        self,
+        send: Callable[[list[Media]], Awaitable[list[str]]],
+        max_in_flight: int = 1,
+        linger_seconds: float = UPLOAD_LINGER_SECONDS,
+    ) -> None:
+        self._send = send
+        self._batch: list[tuple[_Upload, int]] = []
+        self._max_in_flight = max_in_flight
+        self._linger_seconds = linger_seconds
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._in_flight: set[asyncio.Task[None]] = set()
+        self._linger: asyncio.TimerHandle | None = None
+        # flushes started by the linger timer
+        self._flushes: set[asyncio.Task[None]] = set()
+        self._error: BaseException | None = None
+
+    async def add(
+        self,
+        files: Sequence[Media],
+        on_uploaded: Callable[[list[str]], Awaitable[None]],
+    ) -> None:
+        self._raise_error()
+        upload = _Upload(files, on_uploaded)
+        if not files:
+            await on_uploaded([])
+            return
+
+        for i in range(len(files)):
+            self._batch.append((upload, i))
+            if len(self._batch) == MEDIA_GROUP_MAX_SIZE:
+                await self.flush()
+
+        if self._batch and self._linger is None:
+            self._linger = asyncio.get_running_loop().call_later(
+                self._linger_seconds, self._flush_in_background
+            )
+
+    def _flush_in_background(self) -> None:
+        self._linger = None
+        task = asyncio.create_task(self.flush())
+        self._flushes.add(task)
+        task.add_done_callback(self._on_flushed)
+
+    def _on_flushed(self, task: asyncio.Task[None]) -> None:
+        self._flushes.discard(task)
+        if not task.cancelled():
+            # the failure of the album is raised by `add` or `join`
+            task.exception()
+
+    async def flush(self) -> None:
+        if self._linger is not None:
+            self._linger.cancel()
+            self._linger = None
+
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+
+        # the semaphore is fair, albums are started in the order they were made
+        await self._slots.acquire()
+        task = asyncio.create_task(self._send_batch(batch))
+        self._in_flight.add(task)
+        task.add_done_callback(self._on_sent)
+
+        if self._max_in_flight == 1:
+            await asyncio.wait([task])
+            self._raise_error()
+
+    def _on_sent(self, task: asyncio.Task[None]) -> None:
+        self._in_flight.discard(task)
+        self._slots.release()
+        if not task.cancelled() and self._error is None:
+            self._error = task.exception()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    async def _send_batch(self, batch: list[tuple[_Upload, int]]) -> None:
+        file_ids = await self._send([upload.files[i] for upload, i in batch])
+        for (upload, i), file_id in zip(batch, file_ids):
+            upload.file_ids[i] = file_id
+            if len(upload.file_ids) == len(upload.files):
+                await upload.on_uploaded(
+                    [upload.file_ids[j] for j in range(len(upload.files))]
+                )
+
+    async def join(self) -> None:
+        # sends what is left and waits for all albums; the first failure is
+        # raised and the remaining uploads are cancelled
+        try:
+            await self.flush()
+            while (self._flushes or self._in_flight) and self._error is None:
+                await asyncio.wait(
+                    self._flushes | self._in_flight,
+                    return_when=asyncio.FIRST_EXCEPTION,
+                )
+            self._raise_error()
+        except BaseException:
+            self.cancel()
+            raise
+
+    def cancel(self) -> None:
+        if self._linger is not None:
+            self._linger.cancel()
+            self._linger = None
+        for task in self._flushes | self._in_flight:
+            task.cancel()
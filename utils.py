@@ -1,23 +1,52 @@
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import fcntl
 import hashlib
 import os
 import random
 import re
+import shutil
+import signal
 import string
 import subprocess
 import sys
+import time
 import urllib.parse
 import urllib.request
+import weakref
 
 from pathlib import Path
-from typing import Any, TypeVar, cast
+from typing import Any, AsyncContextManager, AsyncIterator, Iterator, TypeVar, cast
+
+import metrics
 
-from image_utils import convert_raw_picture_to_thumbnail_format_and_shape
 from settings import get_default_logger, get_settings
 
 T = TypeVar("T")
 
+DEFAULT_COMMAND_TIMEOUT_SECONDS = 30 * 60
+
+# maximum number of concurrently running processes per binary, shared by all
+# chats; binaries not listed here are not limited
+SUBPROCESS_CONCURRENCY_LIMITS = {
+    "ffmpeg": os.cpu_count() or 1,
+}
+
+_subprocess_semaphores: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, dict[str, asyncio.Semaphore]
+] = weakref.WeakKeyDictionary()
+
+
+FICLONE = 0x40049409  # linux/fs.h
+
+# lock files of the cache files, see cache_file_lock and pin_cache_file
+LOCKS_DIRNAME = "locks"
+LOCK_POLL_INTERVAL_SECONDS = 0.1
+
+_devices_without_reflinks: set[int] = set()
+
 
 def split_into_chunks(lst: list[T], n: int) -> list[list[T]]:
     return [lst[i : i + n] for i in range(0, len(lst), n)]
@@ -50,16 +79,211 @@ def generate_random_filename_in_cache(ext: str = "", length: int = 20) -> Path:
             return filename
 
 
-def run_command(
+def _subprocess_slot(binary: str) -> AsyncContextManager[Any]:
+    if binary not in SUBPROCESS_CONCURRENCY_LIMITS:
+        return contextlib.nullcontext()
+
+    semaphores = _subprocess_semaphores.setdefault(asyncio.get_running_loop(), {})
+    if binary not in semaphores:
+        semaphores[binary] = asyncio.Semaphore(SUBPROCESS_CONCURRENCY_LIMITS[binary])
+    return semaphores[binary]
+
+
+def _kill_process_group(process: asyncio.subprocess.Process) -> None:
+    # the child is started in its own session, so this also takes down
+    # everything it spawned
+    with contextlib.suppress(ProcessLookupError):
+        os.killpg(process.pid, signal.SIGKILL)
+
+
+def _reflink(src: Path, dest: Path) -> bool:
+    device = src.stat().st_dev
+    if device in _devices_without_reflinks:
+        return False
+
+    try:
+        with open(src, "rb") as src_file, open(dest, "wb") as dest_file:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+    except OSError:
+        dest.unlink(missing_ok=True)
+        _devices_without_reflinks.add(device)
+        return False
+
+    return True
+
+
+def clone_file(src: Path, dest: Path) -> None:
+    # a reflink shares the data blocks copy-on-write; the hardlink fallback
+    # shares the inode, so whoever modifies such a file in place has to call
+    # ensure_private_copy first
+    if _reflink(src, dest):
+        return
+
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+def make_working_copy(src: Path) -> Path:
+    copy_filepath = generate_random_filename_in_cache(src.suffix)
+    clone_file(src, copy_filepath)
+    return copy_filepath
+
+
+def ensure_private_copy(path: Path) -> None:
+    # breaks the hardlink of a working file before it's written in place
+    if path.stat().st_nlink <= 1:
+        return
+
+    temp_filename = generate_random_filename_in_cache(path.suffix)
+    shutil.copyfile(path, temp_filename)
+    os.replace(temp_filename, path)
+
+
+def _lock_path(path: Path, kind: str) -> Path:
+    locks_dir = path.parent / LOCKS_DIRNAME
+    locks_dir.mkdir(exist_ok=True)
+    return locks_dir / f"{path.name}.{kind}"
+
+
+def _open_locked(lock_path: Path, operation: int) -> int | None:
+    # flocks the lock file currently at `lock_path`; the last holder of a lock
+    # removes its file, so a lock taken on a file that was removed or
+    # replaced in the meantime is taken again on the current one. None if
+    # the lock is held and `operation` is non-blocking
+    while True:
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, operation)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+
+        try:
+            if os.stat(lock_path).st_ino == os.fstat(fd).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+
+def _unlock(lock_path: Path, fd: int) -> None:
+    # removes the lock file, unless someone else holds a lock on it too
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        pass
+    else:
+        lock_path.unlink(missing_ok=True)
+    finally:
+        # closing the file releases the lock
+        os.close(fd)
+
+
+@contextlib.asynccontextmanager
+async def cache_file_lock(path: Path) -> AsyncIterator[None]:
+    # an exclusive lock for writing a cache file, respected by all processes
+    # sharing the cache directory; the lock is polled, so waiting for it
+    # neither blocks the event loop nor outlives a cancellation
+    lock_path = _lock_path(path, "lock")
+    while (fd := _open_locked(lock_path, fcntl.LOCK_EX | fcntl.LOCK_NB)) is None:
+        await asyncio.sleep(LOCK_POLL_INTERVAL_SECONDS)
+    try:
+        yield
+    finally:
+        _unlock(lock_path, fd)
+
+
+def pin_cache_file(path: Path) -> int:
+    # a shared lock telling the processes sharing the cache directory that
+    # the file is in use; it is only held exclusively for the moment a file
+    # is evicted, so taking it doesn't wait. Returns the fd to unpin with
+    fd = _open_locked(_lock_path(path, "pin"), fcntl.LOCK_SH)
+    assert fd is not None
+    return fd
+
+
+def unpin_cache_file(path: Path, fd: int) -> None:
+    _unlock(_lock_path(path, "pin"), fd)
+
+
+@contextlib.contextmanager
+def unused_cache_file(path: Path) -> Iterator[bool]:
+    # whether no process writes or pins the file; while the block runs, no
+    # process can start to
+    locks: list[tuple[Path, int]] = []
+    try:
+        for kind in ("lock", "pin"):
+            lock_path = _lock_path(path, kind)
+            fd = _open_locked(lock_path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if fd is None:
+                break
+            locks.append((lock_path, fd))
+        yield len(locks) == 2
+    finally:
+        for lock_path, fd in locks:
+            _unlock(lock_path, fd)
+
+
+def remove_stale_lock_files(cache_dir: Path) -> None:
+    # lock files left behind by processes that were killed
+    locks_dir = cache_dir / LOCKS_DIRNAME
+    if not locks_dir.is_dir():
+        return
+
+    for lock_path in locks_dir.iterdir():
+        try:
+            fd = os.open(lock_path, os.O_RDWR)
+        except FileNotFoundError:
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if os.stat(lock_path).st_ino == os.fstat(fd).st_ino:
+                lock_path.unlink()
+        except (BlockingIOError, FileNotFoundError):
+            pass
+        finally:
+            os.close(fd)
+
+
+async def run_command(
     cmd: list[str],
     expected_code: int = 0,
     allow_errors: bool = False,
-    as_shell: bool = False,
     stdin: bytes | None = None,
+    timeout: float | None = DEFAULT_COMMAND_TIMEOUT_SECONDS,
 ) -> subprocess.CompletedProcess:
     get_default_logger().debug(f"Running command: {' '.join(cmd)}")
 
-    ret = subprocess.run(cmd, shell=as_shell, capture_output=True, input=stdin)
+    binary = Path(cmd[0]).name
+    async with _subprocess_slot(binary), metrics.span(f"subprocess.{binary}"):
+        started_at = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=subprocess.DEVNULL if stdin is None else subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(stdin), timeout)
+        except asyncio.TimeoutError:
+            _kill_process_group(process)
+            await process.wait()
+            raise RuntimeError(f"Command {cmd} timed out after {timeout} seconds")
+        except BaseException:
+            _kill_process_group(process)
+            await process.wait()
+            raise
+        finally:
+            metrics.record_subprocess(
+                binary, time.perf_counter() - started_at, process.returncode
+            )
+
+    ret = subprocess.CompletedProcess(
+        cmd, cast(int, process.returncode), stdout, stderr
+    )
 
     if not allow_errors and ret.returncode != expected_code:
         print(ret.stdout)
@@ -82,6 +306,12 @@ def timestamp_to_seconds(timestamp: str) -> int:
     return seconds
 
 
+def bound_to_seconds(bound: str | int) -> int:
+    # a cut bound, in seconds or as a timestamp
+    bound = str(bound).strip()
+    return timestamp_to_seconds(bound) if ":" in bound else int(bound)
+
+
 def url_signature(url: str) -> str:
     return hashlib.md5(url.strip().encode()).hexdigest()
 
@@ -106,24 +336,12 @@ def remove_query_parameter_from_url(url: str, parameter: str) -> str:
     return urllib.parse.urlunparse(u)
 
 
-def download_url_to_cache(url: str) -> Path:
+def download_url_to_cache(url: str, output_filepath: Path | None = None) -> Path:
     assert url.startswith("https")
-    output_filepath = cache_path_for_url(url)
+    output_filepath = output_filepath or cache_path_for_url(url)
     urllib.request.urlretrieve(url, output_filepath)
     return output_filepath
 
 
-def url_to_thumbnail_filename(picture_url: str) -> Path:
-    expected_filename = cache_path_for_url(picture_url)
-    if expected_filename.exists():
-        return expected_filename
-
-    picture_filename = download_url_to_cache(picture_url)
-    thumbnail = convert_raw_picture_to_thumbnail_format_and_shape(picture_filename)
-    os.rename(thumbnail, picture_filename)
-    assert expected_filename == picture_filename
-    return picture_filename
-
-
 def _escape_markdown_v2(txt: str) -> str:
     return re.sub("(?=[~>#+-=|{}.!])", "\\\\", txt)
@@ -1,142 +1,107 @@
 from __future__ import annotations
 
+import asyncio
 import json
-import os
+import threading
+import time
 
 from pathlib import Path
+from typing import Any, AsyncIterator, Callable, cast
 
+import yt_dlp
+
+import metrics
 import mp3_utils
+import ytdl_engine
 
-from image_utils import (
-    DESIRED_THUMBNAIL_FORMAT,
-    convert_image_to_format,
-    crop_image_to_square,
-)
+from cover_store import find_cover_for_url
 from settings import get_default_logger
-from utils import cache_path_for_mp3_url, run_command
-
+from utils import cache_path_for_mp3_url
 
-def find_info_json_file_path(mp3_path: Path) -> Path:
-    return [
-        p
-        for p in mp3_path.parent.glob(f"{mp3_path.stem}.*")
-        if p.name.endswith(".info.json")
-    ][0]
+CHAPTERS_SUFFIX = ".chapters.json"
 
+PLAYLIST_CACHE_TTL_SECONDS = 10 * 60
+# how many times a playlist url may point to another url before giving up
+PLAYLIST_MAX_REDIRECTS = 5
+PLAYLIST_EXPANSION_OPTIONS: dict[str, Any] = {
+    "skip_download": True,
+    "quiet": True,
+    "no_warnings": True,
+    "noprogress": True,
+}
 
-def get_chapter_names_from_info_json_file(info_json_path: Path) -> list[str]:
-    found_metadata = json.loads(info_json_path.read_text())
-    chapters = found_metadata["chapters"]
-    chapters.sort(key=lambda c: c["start_time"])
-    return [c["title"] for c in chapters]
+# playlist url -> (expiry time, video urls)
+_expanded_playlists: dict[str, tuple[float, list[str]]] = {}
 
 
-def set_metadata_from_info_file(
-    mp3_path: Path, info_json_path: Path, title: str | None = None
-) -> None:
-    found_metadata = json.loads(info_json_path.read_text())
+def chapters_path_for_mp3(mp3_path: Path) -> Path:
+    return mp3_path.with_suffix(CHAPTERS_SUFFIX)
 
-    if title is None:
-        title = found_metadata["title"]
-
-    mp3_utils.change_metadata(mp3_path, "title", title)
-    if "album" in found_metadata:
-        mp3_utils.change_metadata(mp3_path, "album", found_metadata["album"])
 
+def save_chapters(mp3_path: Path, info: dict[str, Any]) -> Path:
+    chapters = sorted(info.get("chapters") or [], key=lambda c: c["start_time"])
+    chapters_path = chapters_path_for_mp3(mp3_path)
+    chapters_path.write_text(
+        json.dumps(
+            [{k: c[k] for k in ("title", "start_time", "end_time")} for c in chapters]
+        )
+    )
+    return chapters_path
 
-def get_thumbnail_path_for_mp3(mp3_path: Path) -> Path | None:
-    thumbnails = [
-        p
-        for p in mp3_path.parent.glob(f"{mp3_path.stem}.*")
-        if not p.name.endswith(".info.json") and not p.name.endswith(".mp3")
-    ]
 
-    if len(thumbnails) == 0:
-        get_default_logger().info(f"No thumbnails found for {mp3_path}")
+def load_chapters(mp3_path: Path) -> list[dict[str, Any]] | None:
+    # None if the chapters of the file are not known
+    try:
+        return cast(
+            list[dict[str, Any]],
+            json.loads(chapters_path_for_mp3(mp3_path).read_text()),
+        )
+    except FileNotFoundError:
         return None
 
-    if any(
-        desired_format_thumbnails := [
-            t for t in thumbnails if t.suffix[1:] == DESIRED_THUMBNAIL_FORMAT
-        ]
-    ):
-        thumbnail = desired_format_thumbnails[0]
-    else:
-        thumbnail = convert_image_to_format(thumbnails[0], DESIRED_THUMBNAIL_FORMAT)
-        thumbnails.append(thumbnail)
-
-    assert thumbnail.suffix[1:] == DESIRED_THUMBNAIL_FORMAT
 
-    crop_image_to_square(thumbnail)
+async def cut_chapters(mp3_path: Path, chapters: list[dict[str, Any]]) -> list[Path]:
+    # all chapters are cut in one pass, the tags and the cover of the source
+    # are carried over and every chapter gets its own title
+    return await mp3_utils.cut_segments(
+        mp3_path,
+        [(c["start_time"], c["end_time"] - c["start_time"]) for c in chapters],
+        segment_tags=[{"title": c["title"]} for c in chapters],
+    )
 
-    for thumbnail_filepath in thumbnails:
-        if thumbnail_filepath != thumbnail:
-            os.remove(thumbnail_filepath)
 
-    return thumbnail
+def tags_from_info(info: dict[str, Any]) -> dict[str, str]:
+    tags = {"title": info["title"]}
+    if "album" in info:
+        tags["album"] = info["album"]
+    return tags
 
 
-def ytdl_download_song(url: str, split_chapters: bool) -> list[Path]:
+async def ytdl_download_song(url: str) -> Path:
+    # the chapters of the video are saved next to the audio file, so chapter
+    # requests can be served from the same download
     output_filepath = cache_path_for_mp3_url(url)
 
     get_default_logger().info(
         f"Downloading youtube audio from url: {url} with filename {output_filepath}"
     )
 
-    output_filepath_str = output_filepath.as_posix()
-
-    split_chapters_args = [
-        "--split-chapters",
-        "--output",
-        f"chapter:{output_filepath_str}.%(section_number)s.chapter.mp3",
-    ]
-
-    run_command(
-        [
-            "yt-dlp",
-            "-f",
-            "bestaudio/best",
-            "--extract-audio",
-            "--write-thumbnail",
-            "--write-info-json",
-            "--no-write-comments",
-            "--audio-format",
-            "mp3",
-            "--audio-quality",
-            "0",
-            "--output",
-            output_filepath_str,
-            *(split_chapters_args if split_chapters else []),
-            url,
-        ],
-    )
+    with metrics.span("download.ytdl"):
+        info = await ytdl_engine.download(url, output_filepath.as_posix())
 
     assert output_filepath.exists()
+    metrics.record_bytes("download", output_filepath.stat().st_size)
     get_default_logger().info(f"Audio from url {url} downloaded")
 
-    info_json_file = find_info_json_file_path(output_filepath)
-    thumbnail_image_file = get_thumbnail_path_for_mp3(output_filepath)
-
-    if not split_chapters:
-        if thumbnail_image_file is not None:
-            mp3_utils.set_cover(output_filepath, thumbnail_image_file)
-        set_metadata_from_info_file(output_filepath, info_json_file)
-        results = [output_filepath]
-    else:
-        results = []
-        chapter_titles = get_chapter_names_from_info_json_file(info_json_file)
-        for chapter_idx, chapter_title in enumerate(chapter_titles, start=1):
-            filename = Path(output_filepath_str + f".{chapter_idx}.chapter.mp3")
-            if thumbnail_image_file is not None:
-                mp3_utils.set_cover(filename, thumbnail_image_file)
-            set_metadata_from_info_file(filename, info_json_file, title=chapter_title)
-            results.append(filename)
+    # tracks of an album usually share their thumbnail url
+    cover_filepath = await find_cover_for_url(info.get("thumbnail"))
+    await mp3_utils.write_tags(
+        output_filepath, tags=tags_from_info(info), cover_filepath=cover_filepath
+    )
 
-    info_json_file.unlink()
-    if thumbnail_image_file is not None:
-        thumbnail_image_file.unlink()
+    save_chapters(output_filepath, info)
 
-    return results
+    return output_filepath
 
 
 def extract_youtube_id(link: str) -> str:
@@ -155,18 +120,82 @@ def extract_youtube_id(link: str) -> str:
     return ids[0]
 
 
-def playlist_url_to_video_urls(playlist_url: str) -> list[str]:
-    p1 = run_command(
-        ["yt-dlp", "--skip-download", "--flat-playlist", playlist_url, "-j"],
-        allow_errors=True,
-    )
-    p2 = run_command(["jq", "-r", ".webpage_url"], stdin=p1.stdout)
-
-    # Validate URLs
-    possible_links = p2.stdout.decode("utf-8").split("\n")
-    links = [
-        url
-        for url in possible_links
-        if url.startswith("https") and "playlist" not in url
-    ]
-    return links
+def _is_video_url(url: str) -> bool:
+    return url.startswith("https") and "playlist" not in url
+
+
+def _iterate_playlist_entries(
+    playlist_url: str, on_url: Callable[[str], None], stop: threading.Event
+) -> None:
+    # without processing, the entries of the playlist are a lazy iterator;
+    # every page of the playlist is fetched only when it is reached
+    with yt_dlp.YoutubeDL(PLAYLIST_EXPANSION_OPTIONS) as ydl:
+        info = ydl.extract_info(playlist_url, download=False, process=False)
+        # an unprocessed result may only point to the actual playlist
+        for _ in range(PLAYLIST_MAX_REDIRECTS):
+            if (info or {}).get("_type") not in ("url", "url_transparent"):
+                break
+            info = ydl.extract_info(
+                info["url"], download=False, process=False, ie_key=info.get("ie_key")
+            )
+        else:
+            raise yt_dlp.utils.DownloadError(f"Too many redirects of {playlist_url}")
+
+        for entry in (info or {}).get("entries") or []:
+            if stop.is_set():
+                return
+            url = entry.get("webpage_url") or entry.get("url")
+            if url and _is_video_url(url):
+                on_url(url)
+
+
+async def iterate_playlist_video_urls(playlist_url: str) -> AsyncIterator[str]:
+    cached = _expanded_playlists.get(playlist_url)
+    is_cached = cached is not None and cached[0] > time.monotonic()
+    metrics.record_cache_lookup("playlist", is_cached)
+    if cached is not None and is_cached:
+        for url in cached[1]:
+            yield url
+        return
+
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue[str | None] = asyncio.Queue()
+    stop = threading.Event()
+
+    def put(url: str | None) -> None:
+        loop.call_soon_threadsafe(queue.put_nowait, url)
+
+    def expand() -> bool:
+        # runs in a copy of the context, so the span joins the request's trace
+        try:
+            with metrics.span("playlist_expansion"):
+                _iterate_playlist_entries(playlist_url, put, stop)
+            return True
+        except Exception as e:
+            # like the unavailable items, a failure ends the playlist early
+            get_default_logger().warning(
+                f"Expanding playlist {playlist_url} failed", exc_info=e
+            )
+            return False
+        finally:
+            put(None)
+
+    expansion = asyncio.ensure_future(asyncio.to_thread(expand))
+    urls: list[str] = []
+    try:
+        while (video_url := await queue.get()) is not None:
+            urls.append(video_url)
+            yield video_url
+    finally:
+        stop.set()
+
+    # a failed or empty expansion is retried by the next request
+    if await expansion and urls:
+        _remember_expanded_playlist(playlist_url, urls)
+
+
+def _remember_expanded_playlist(playlist_url: str, urls: list[str]) -> None:
+    now = time.monotonic()
+    for url in [u for u, (expires, _) in _expanded_playlists.items() if expires < now]:
+        del _expanded_playlists[url]
+    _expanded_playlists[playlist_url] = (now + PLAYLIST_CACHE_TTL_SECONDS, urls)
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import asyncio
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any
+
+import yt_dlp
+
+# this module is imported by the pool workers, keep its imports light
+
+YTDL_WORKERS = 4
+YTDL_SOCKET_TIMEOUT_SECONDS = 30
+# covers the download and the conversion of hours long videos
+YTDL_DOWNLOAD_TIMEOUT_SECONDS = 30 * 60
+
+YTDL_OPTIONS: dict[str, Any] = {
+    "format": "bestaudio/best",
+    "getcomments": False,
+    "postprocessors": [
+        {
+            "key": "FFmpegExtractAudio",
+            "preferredcodec": "mp3",
+            "preferredquality": "0",
+        }
+    ],
+    "socket_timeout": YTDL_SOCKET_TIMEOUT_SECONDS,
+    "quiet": True,
+    "no_warnings": True,
+    "noprogress": True,
+}
+
+# per worker process, kept for the lifetime of the worker so that the
+# extractors and their caches are initialised once
+_downloader: yt_dlp.YoutubeDL | None = None
+
+
+def _get_downloader() -> yt_dlp.YoutubeDL:
+    global _downloader
+
+    if _downloader is None:
+        _downloader = yt_dlp.YoutubeDL(YTDL_OPTIONS)
+    return _downloader
+
+
+def _download(url: str, output_template: str) -> dict[str, Any]:
+    ydl = _get_downloader()
+    outtmpl = ydl.params["outtmpl"]
+    default_template = outtmpl["default"]
+    outtmpl["default"] = output_template
+
+    try:
+        info = ydl.extract_info(url, download=True)
+    except yt_dlp.utils.YoutubeDLError as e:
+        # the original carries a traceback, which can't be sent between processes
+        raise RuntimeError(f"Downloading {url} failed: {e}") from None
+    finally:
+        outtmpl["default"] = default_template
+
+    return dict(ydl.sanitize_info(info))
+
+
+YTDL_POOL: ProcessPoolExecutor | None = None
+
+
+def get_ytdl_pool() -> ProcessPoolExecutor:
+    global YTDL_POOL
+
+    if YTDL_POOL is None:
+        # the bot runs threads, forking it is not safe
+        YTDL_POOL = ProcessPoolExecutor(
+            YTDL_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    return YTDL_POOL
+
+
+def _recycle_pool(pool: ProcessPoolExecutor) -> None:
+    # a running task can only be stopped by killing its worker, which breaks
+    # the whole pool; the next download starts a new one
+    global YTDL_POOL
+
+    if YTDL_POOL is pool:
+        YTDL_POOL = None
+    for process in list((pool._processes or {}).values()):
+        process.kill()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def _download_in_pool(
+    pool: ProcessPoolExecutor, url: str, output_template: str
+) -> dict[str, Any]:
+    future = asyncio.get_running_loop().run_in_executor(
+        pool, _download, url, output_template
+    )
+    try:
+        return await asyncio.wait_for(future, YTDL_DOWNLOAD_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        _recycle_pool(pool)
+        raise RuntimeError(f"Downloading {url} timed out") from None
+    except asyncio.CancelledError:
+        _recycle_pool(pool)
+        raise
+
+
+async def download(url: str, output_template: str) -> dict[str, Any]:
+    # returns the sanitized info dict of the downloaded video. A download
+    # that times out or is cancelled is stopped with its pool, the other
+    # downloads running in that pool are then retried once in a new one
+    pool = get_ytdl_pool()
+    try:
+        return await _download_in_pool(pool, url, output_template)
+    except BrokenProcessPool:
+        if YTDL_POOL is pool:
+            # a worker died on its own
+            _recycle_pool(pool)
+            raise
+
+    return await _download_in_pool(get_ytdl_pool(), url, output_template)
+
+
+def shutdown_ytdl_engine() -> None:
+    global YTDL_POOL
+
+    if YTDL_POOL is not None:
+        YTDL_POOL.shutdown(wait=False, cancel_futures=True)
+        YTDL_POOL = None